@@ -0,0 +1,41 @@
+import java.util.ArrayList;
+import java.util.List;
+
+import org.antlr.v4.Tool;
+
+// Runs the ANTLR tool on many grammars in the same JVM, see build_all.py:
+//   java -cp antlr-4.5.3-complete.jar:. AntlrBatch [options] a/Mu.g4 b/Mu.g4 ...
+// Each grammar is generated in its own directory, by its own Tool, as
+// the tool only keeps one of several grammars with the same name.
+// "generated <grammar>" is printed for each grammar without errors.
+public class AntlrBatch {
+    public static void main(String[] args) {
+        List<String> options = new ArrayList<String>();
+        List<String> grammars = new ArrayList<String>();
+
+        for (String arg : args) {
+            if (arg.endsWith(".g4")) {
+                grammars.add(arg);
+            } else {
+                options.add(arg);
+            }
+        }
+
+        int failed = 0;
+        for (String grammar : grammars) {
+            List<String> toolArgs = new ArrayList<String>(options);
+            toolArgs.add(grammar);
+
+            Tool tool = new Tool(toolArgs.toArray(new String[0]));
+            tool.processGrammarsOnCommandLine();
+
+            if (tool.getNumErrors() == 0) {
+                System.out.println("generated " + grammar);
+            } else {
+                failed++;
+            }
+        }
+
+        System.exit(failed == 0 ? 0 : 1);
+    }
+}
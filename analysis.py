@@ -0,0 +1,299 @@
+from __future__ import print_function
+
+from customprog import (Program, OP_AND, OP_ADD, OP_NOT, OP_BR,
+                        ALWAYS, N, Z, P,
+                        InfiniteLoopError, NotInitialisedRegisterError)
+from blockcompiler import splitBlocks
+
+
+def reads(program, pc):
+    # register slots which must be initialised to execute pc
+    op = program.ops[pc]
+    imm = program.imm[pc]
+
+    if op == OP_ADD:
+        return [program.sr1[pc]] + ([] if imm else [program.sr2[pc]])
+    elif op == OP_NOT:
+        return [program.sr1[pc]]
+    elif op == OP_AND:
+        if imm:
+            # And with 0 does not read sr1
+            return [program.sr1[pc]] if program.sr2[pc] != 0 else []
+        else:
+            # sr1 is not read when sr2 is 0, it is only known at run time
+            return [program.sr2[pc]]
+
+    return []
+
+
+def writes(program, pc):
+    if program.ops[pc] in (OP_AND, OP_ADD, OP_NOT):
+        return [program.dr[pc]]
+
+    return []
+
+
+class Analysis:
+    # Control flow and dataflow of a program, without running it:
+    # - unreachable: blocks which are never reached from the entry
+    # - uninitialisedReads: (pc, register) read while never written
+    #   on any path to pc
+    # - error: exception that State.run is certain to raise, or None
+    #   when it cannot be decided statically
+    def __init__(self, instrs, maxInstructions=100000, program=None):
+        self.program = program or Program(instrs)
+        self.maxInstructions = maxInstructions
+
+        self.blocks = splitBlocks(self.program)
+        self.blockEnds = dict(self.blocks)
+        self.successors = dict((start, self._successors(start, end))
+                               for start, end in self.blocks)
+
+        self.reachable = self._reachable()
+        self.unreachable = [(start, end) for start, end in self.blocks
+                            if start not in self.reachable]
+        self.uninitialisedReads = self._uninitialisedReads()
+
+        self.error = self._classify()
+
+    def _successors(self, start, end):
+        program = self.program
+        br = end - 1
+
+        if program.ops[br] == OP_BR:
+            if program.dr[br] == ALWAYS:
+                successors = [program.sr1[br]]
+            else:
+                successors = [program.sr1[br], end]
+        else:
+            successors = [end]
+
+        # the end of the program and missing labels are not blocks
+        return [s for s in successors if 0 <= s < len(program.ops)]
+
+    def _reachable(self):
+        reachable = set()
+        stack = [0] if self.blocks else []
+
+        while stack:
+            start = stack.pop()
+            if start not in reachable:
+                reachable.add(start)
+                stack.extend(self.successors[start])
+
+        return reachable
+
+    def _uninitialisedReads(self):
+        program = self.program
+
+        # registers which may be written before entering each block
+        defined = {0: frozenset()} if self.blocks else {}
+        worklist = list(defined)
+
+        while worklist:
+            start = worklist.pop()
+            out = set(defined[start])
+            for pc in range(start, self.blockEnds[start]):
+                out.update(writes(program, pc))
+
+            for s in self.successors[start]:
+                if s not in defined or not out <= defined[s]:
+                    defined[s] = frozenset(out | defined.get(s, set()))
+                    worklist.append(s)
+
+        result = []
+        for start, end in self.blocks:
+            if start not in defined:
+                continue
+
+            current = set(defined[start])
+            for pc in range(start, end):
+                for slot in reads(program, pc):
+                    if slot not in current:
+                        result.append((pc, program.registerNames[slot]))
+                current.update(writes(program, pc))
+
+        return result
+
+    def _classify(self):
+        # Follows the only path the program can take, block by block.
+        # Everything is known on that path, as the program has no input,
+        # so reads of uninitialised registers are found exactly. The
+        # walk stops when a block is entered twice: if all the branches
+        # taken since its first visit only depended on constants of
+        # their own block, the same path repeats forever.
+        program = self.program
+        if program.linkError is not None:
+            return program.linkError
+
+        ops, drs, sr1s, sr2s, imms = (program.ops, program.dr, program.sr1,
+                                      program.sr2, program.imm)
+        names = program.registerNames
+        values = [None] * len(names)
+        last = None
+        count = 0
+
+        entered = {}
+        steps = 0
+        # last step where the path may change on the next iteration
+        unstable = -1
+
+        pc = 0
+        while pc < len(ops):
+            if pc in entered:
+                if unstable < entered[pc]:
+                    return InfiniteLoopError('loop at pc %d never exits' % pc)
+                return None
+
+            entered[pc] = steps
+
+            # registers computed in this block from immediates only
+            constants = set()
+            lastConstant = False
+
+            end = self.blockEnds[pc]
+            nextPc = end
+            for i in range(pc, end):
+                op = ops[i]
+
+                if op in (OP_AND, OP_ADD, OP_NOT):
+                    v0 = values[sr1s[i]]
+                    constant = sr1s[i] in constants
+
+                    if op == OP_NOT:
+                        v1 = 0
+                    elif imms[i]:
+                        v1 = sr2s[i]
+                    else:
+                        v1 = values[sr2s[i]]
+                        constant = constant and sr2s[i] in constants
+
+                    if op == OP_AND and v1 == 0 and (imms[i] or v0 is None):
+                        value = 0
+                        constant = bool(imms[i])
+                        if not imms[i]:
+                            # sr1 may be read once sr2 changes
+                            unstable = steps
+                    elif v0 is None:
+                        return NotInitialisedRegisterError(names[sr1s[i]])
+                    elif v1 is None:
+                        return NotInitialisedRegisterError(names[sr2s[i]])
+                    elif op == OP_AND:
+                        value = v0 & v1
+                    elif op == OP_ADD:
+                        value = v0 + v1
+                    else:
+                        value = ~v0
+
+                    values[drs[i]] = last = value
+                    lastConstant = constant
+                    if constant:
+                        constants.add(drs[i])
+                    else:
+                        constants.discard(drs[i])
+                elif op == OP_BR:
+                    mask = drs[i]
+                    if mask == ALWAYS:
+                        nextPc = sr1s[i]
+                    else:
+                        if last is None:
+                            return NotInitialisedRegisterError()
+                        if mask & (N if last < 0 else Z if last == 0 else P):
+                            nextPc = sr1s[i]
+                        if not lastConstant:
+                            unstable = steps
+
+                count += 1
+                if count > self.maxInstructions:
+                    return InfiniteLoopError()
+
+            pc = nextPc
+            steps += 1
+
+        return None
+
+    def describe(self):
+        lines = []
+        for start, end in self.unreachable:
+            lines.append('unreachable code: pc %d to %d' % (start, end - 1))
+        for pc, r in self.uninitialisedReads:
+            lines.append('pc %d reads %s which is never initialised' % (pc, r))
+        if self.error is not None:
+            lines.append('%s: %s' % (type(self.error).__name__, self.error))
+
+        return lines
+
+if __name__ == '__main__':
+    import unittest
+
+    from customprog import State, Label, And, Add, Not, Br
+
+    r0 = "temp_0"
+    r1 = "temp_1"
+    r2 = "temp_2"
+
+    class Test(unittest.TestCase):
+        def _error(self, instrs):
+            error = Analysis(instrs).error
+            return None if error is None else type(error)
+
+        def test_terminating(self):
+            self.assertEqual(self._error([And(r0, r0, 0), Add(r0, r0, 3),
+                                          Label("loop"),
+                                          Add(r0, r0, -1),
+                                          Br("p", "loop")]), None)
+
+        def test_unconditional_loop(self):
+            self.assertEqual(self._error([Label("start"), Br("", "start")]),
+                             InfiniteLoopError)
+
+        def test_constant_condition_loop(self):
+            # while(true) {}
+            self.assertEqual(self._error([Label("begin"),
+                                          And(r0, r0, 0),
+                                          Add(r0, r0, 1),
+                                          Br("z", "end"),
+                                          Br("", "begin"),
+                                          Label("end")]),
+                             InfiniteLoopError)
+
+        def test_variable_condition_loop(self):
+            # the condition is computed before the loop: run it instead
+            self.assertEqual(self._error([And(r0, r0, 0),
+                                          Add(r0, r0, 1),
+                                          Label("begin"),
+                                          Add(r1, r0, 0),
+                                          Br("z", "end"),
+                                          Br("", "begin"),
+                                          Label("end")]), None)
+
+        def test_uninitialised(self):
+            instrs = [And(r0, r0, 0), Br("z", "l"), Not(r1, r1), Label("l"),
+                      Add(r2, r0, r1)]
+            analysis = Analysis(instrs)
+
+            self.assertEqual(analysis.uninitialisedReads, [(2, r1)])
+            self.assertEqual(type(analysis.error), NotInitialisedRegisterError)
+
+        def test_unreachable(self):
+            analysis = Analysis([And(r0, r0, 0), Br("", "l"),
+                                 Add(r0, r0, 1), Label("l")])
+
+            self.assertEqual(analysis.unreachable, [(2, 3)])
+            self.assertEqual(analysis.error, None)
+
+        def test_agrees_with_state(self):
+            programs = [[And(r0, r0, 0), And(r1, r0, r2)],
+                        [And(r1, r1, 0), And(r0, r2, r1)],
+                        [Br("n", "l"), Label("l")],
+                        [Br("", "missing")]]
+
+            for instrs in programs:
+                error = self._error(instrs)
+                if error is not None:
+                    with self.assertRaises(error):
+                        State(instrs).run()
+                else:
+                    State(instrs).run()
+
+    unittest.main()
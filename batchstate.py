@@ -0,0 +1,345 @@
+from __future__ import print_function
+
+import numpy
+
+from customprog import (State, OP_AND, OP_ADD, OP_NOT, OP_BR, ALWAYS, N, Z, P,
+                        InfiniteLoopError, NotInitialisedRegisterError)
+
+# lanes whose values leave this range are run again by State, as int64
+# lanes would not match python integers anymore
+_LIMIT = 2 ** 61
+
+
+def shape(program):
+    # programs of the same shape only differ by their immediate values
+    sr2 = [0 if imm else sr2 for sr2, imm in zip(program.sr2, program.imm)]
+
+    return (tuple(program.ops), tuple(program.dr), tuple(program.sr1),
+            tuple(sr2), tuple(program.imm), tuple(program.registerNames))
+
+
+class BatchState:
+    # Runs States of the same shape at once, one numpy lane per State.
+    # Each lane has its own pc: the lanes at the smallest pc execute
+    # the next instruction together, so lanes which took different
+    # branches join again when reaching the same code.
+    def __init__(self, states):
+        self.states = states
+        self.program = states[0].program
+        self.maxInstructions = states[0].maxInstructions
+        self.detectLoops = states[0].detectLoops
+
+        # errors raised by each lane, as State.run would
+        self.errors = [None] * len(states)
+
+    def run(self):
+        program = self.program
+        lanes = len(self.states)
+
+        if program.linkError is not None:
+            self.errors = [program.linkError] * lanes
+            return
+
+        try:
+            self.immediates = numpy.array([list(s.program.sr2)
+                                           for s in self.states],
+                                          dtype=numpy.int64).T
+        except OverflowError:
+            self._runScalar(range(lanes))
+            return
+
+        registers = len(program.registerNames)
+        self.values = numpy.zeros((registers, lanes), dtype=numpy.int64)
+        self.defined = numpy.zeros((registers, lanes), dtype=bool)
+        self.last = numpy.zeros(lanes, dtype=numpy.int64)
+        self.lastDefined = numpy.zeros(lanes, dtype=bool)
+        self.pc = numpy.zeros(lanes, dtype=numpy.int64)
+        self.count = numpy.zeros(lanes, dtype=numpy.int64)
+        self.active = numpy.ones(lanes, dtype=bool)
+        self.overflow = numpy.zeros(lanes, dtype=bool)
+
+        if self.detectLoops:
+            # per lane Brent's cycle detection, see State._backEdge
+            self.savedValues = numpy.zeros_like(self.values)
+            self.savedDefined = numpy.zeros_like(self.defined)
+            self.savedLast = numpy.zeros_like(self.last)
+            self.savedLastDefined = numpy.zeros_like(self.lastDefined)
+            self.savedPc = numpy.full(lanes, -1, dtype=numpy.int64)
+            self.backEdges = numpy.zeros(lanes, dtype=numpy.int64)
+            self.nextSave = numpy.ones(lanes, dtype=numpy.int64)
+
+        self.active &= self.pc < len(program.ops)
+        while self.active.any():
+            pc = self.pc[self.active].min()
+            self._step(pc, numpy.flatnonzero(self.active & (self.pc == pc)))
+
+        self._runScalar(numpy.flatnonzero(self.overflow))
+
+        for k, state in enumerate(self.states):
+            if not self.overflow[k]:
+                state.values[:] = [int(v) if d else None for v, d in
+                                   zip(self.values[:, k], self.defined[:, k])]
+                state.lastRegister = (int(self.last[k])
+                                      if self.lastDefined[k] else None)
+                state.executed = int(self.count[k])
+
+    def _runScalar(self, lanes):
+        for k in lanes:
+            try:
+                self.states[k].run()
+            except Exception as e:
+                self.errors[k] = e
+
+    def _fail(self, lanes, error):
+        for k in lanes:
+            self.errors[k] = error
+        self.active[lanes] = False
+
+    def _step(self, pc, lanes):
+        program = self.program
+        op = program.ops[pc]
+        names = program.registerNames
+
+        if op in (OP_AND, OP_ADD, OP_NOT):
+            sr1, sr2, dr = program.sr1[pc], program.sr2[pc], program.dr[pc]
+            v0 = self.values[sr1, lanes]
+            d0 = self.defined[sr1, lanes]
+
+            if op == OP_NOT:
+                v1 = 0
+                d1 = numpy.ones(len(lanes), dtype=bool)
+            elif program.imm[pc]:
+                v1 = self.immediates[pc, lanes]
+                d1 = numpy.ones(len(lanes), dtype=bool)
+            else:
+                v1 = self.values[sr2, lanes]
+                d1 = self.defined[sr2, lanes]
+
+            if op == OP_AND:
+                # And with 0 does not need sr1
+                ok = (d0 & d1) | (d1 & (v1 == 0))
+                result = numpy.where(d0 & d1, v0 & v1, 0)
+                self._fail(lanes[~ok], NotInitialisedRegisterError())
+            elif op == OP_ADD:
+                ok = d0 & d1
+                result = v0 + v1
+                self._fail(lanes[~d0], NotInitialisedRegisterError(names[sr1]))
+                if not program.imm[pc]:
+                    self._fail(lanes[d0 & ~d1],
+                               NotInitialisedRegisterError(names[sr2]))
+            else:
+                ok = d0
+                result = ~v0
+                self._fail(lanes[~d0], NotInitialisedRegisterError(names[sr1]))
+
+            lanes, result = lanes[ok], result[ok]
+
+            big = numpy.abs(result) > _LIMIT
+            self.overflow[lanes[big]] = True
+            self.active[lanes[big]] = False
+            lanes, result = lanes[~big], result[~big]
+
+            self.values[dr, lanes] = result
+            self.defined[dr, lanes] = True
+            self.last[lanes] = result
+            self.lastDefined[lanes] = True
+            self.pc[lanes] = pc + 1
+        elif op == OP_BR:
+            mask, target = program.dr[pc], program.sr1[pc]
+
+            if mask == ALWAYS:
+                taken = numpy.ones(len(lanes), dtype=bool)
+            else:
+                # do not read the last register if
+                # the branch is unconditional
+                ld = self.lastDefined[lanes]
+                self._fail(lanes[~ld], NotInitialisedRegisterError())
+                lanes = lanes[ld]
+
+                last = self.last[lanes]
+                code = numpy.where(last < 0, N, numpy.where(last == 0, Z, P))
+                taken = (code & mask) != 0
+
+            self.pc[lanes] = numpy.where(taken, target, pc + 1)
+
+            if self.detectLoops and target <= pc:
+                self._backEdge(pc, lanes[taken])
+        else:
+            self.pc[lanes] = pc + 1
+
+        lanes = lanes[self.active[lanes]]
+        self.count[lanes] += 1
+        self._fail(lanes[self.count[lanes] > self.maxInstructions],
+                   InfiniteLoopError())
+
+        self.active[lanes] &= self.pc[lanes] < len(program.ops)
+
+    def _backEdge(self, pc, lanes):
+        values = self.values[:, lanes]
+        defined = self.defined[:, lanes]
+        lastDefined = self.lastDefined[lanes]
+
+        same = ((self.savedPc[lanes] == pc) &
+                (self.savedDefined[:, lanes] == defined).all(axis=0) &
+                ((self.savedValues[:, lanes] == values) | ~defined).all(axis=0) &
+                (self.savedLastDefined[lanes] == lastDefined) &
+                ((self.savedLast[lanes] == self.last[lanes]) | ~lastDefined))
+
+        self._fail(lanes[same], InfiniteLoopError())
+        lanes = lanes[~same]
+
+        self.backEdges[lanes] += 1
+        save = lanes[self.backEdges[lanes] == self.nextSave[lanes]]
+        self.savedValues[:, save] = self.values[:, save]
+        self.savedDefined[:, save] = self.defined[:, save]
+        self.savedLast[save] = self.last[save]
+        self.savedLastDefined[save] = self.lastDefined[save]
+        self.savedPc[save] = pc
+        self.nextSave[save] *= 2
+        self.backEdges[save] = 0
+
+
+def runStates(states):
+    # Runs States lane-parallel, grouped by shape, and returns the
+    # error raised by each of them, or None. Subclasses of State, as
+    # CompiledState or LC3State, are run by their own run
+    errors = [None] * len(states)
+    groups = {}
+    for k, state in enumerate(states):
+        if type(state) is not State:
+            try:
+                state.run()
+            except Exception as e:
+                errors[k] = e
+            continue
+
+        key = (shape(state.program), state.maxInstructions, state.detectLoops)
+        groups.setdefault(key, []).append(k)
+
+    for indices in groups.values():
+        batch = BatchState([states[k] for k in indices])
+        batch.run()
+
+        for k, error in zip(indices, batch.errors):
+            errors[k] = error
+
+    return errors
+
+if __name__ == '__main__':
+    import unittest
+
+    from customprog import Label, And, Add, Not, Br
+
+    r0 = "temp_0"
+    r1 = "temp_1"
+    r2 = "temp_2"
+
+    class Test(unittest.TestCase):
+        def _compare(self, programs, maxInstructions=100000,
+                     detectLoops=False):
+            scalar = []
+            for instrs in programs:
+                state = State(instrs, maxInstructions,
+                              detectLoops=detectLoops)
+                try:
+                    state.run()
+                    error = None
+                except Exception as e:
+                    error = type(e)
+                scalar.append((error, dict(state.registers),
+                               state.lastRegister,
+                               state.executed if error is None else None))
+
+            states = [State(instrs, maxInstructions, detectLoops=detectLoops)
+                      for instrs in programs]
+            errors = runStates(states)
+            batch = [(None if error is None else type(error),
+                      dict(state.registers), state.lastRegister,
+                      state.executed if error is None else None)
+                     for state, error in zip(states, errors)]
+
+            self.assertEqual(scalar, batch)
+
+            return batch
+
+        def _countdown(self, start, step):
+            return [And(r0, r0, 0),
+                    Add(r0, r0, start),
+                    And(r1, r1, 0),
+                    Label("loop"),
+                    Add(r1, r1, 2),
+                    Add(r0, r0, step),
+                    Br("p", "loop"),
+                    Not(r2, r1)]
+
+        def test_divergent_loops(self):
+            results = self._compare([self._countdown(start, -1)
+                                     for start in range(-3, 15)])
+
+            self.assertEqual(results[-1][1][r1], 28)
+
+        def test_branching(self):
+            programs = []
+            for v in range(-3, 4):
+                instrs = []
+                for test in ["", "n", "nz", "z", "zp", "p", "np", "nzp"]:
+                    instrs.extend([And(r0, r0, 0),
+                                   Add(r0, r0, v),
+                                   Br(test, "l" + test),
+                                   And("r" + test, "r" + test, 0),
+                                   Label("l" + test)])
+                programs.append(instrs)
+
+            self._compare(programs)
+
+        def test_infinite_loops(self):
+            programs = [self._countdown(start, 1) for start in range(-3, 3)]
+
+            for maxInstructions in [10, 1000]:
+                self._compare(programs, maxInstructions)
+
+            # r0 cycles through 4 values, so do the states
+            programs = [[And(r0, r0, 0), Add(r0, r0, start),
+                         Label("loop"),
+                         Add(r0, r0, 1),
+                         And(r0, r0, 3),
+                         Br("zp", "loop")] for start in range(-3, 3)]
+            self._compare(programs, 10 ** 9, detectLoops=True)
+
+        def test_notinitialised(self):
+            self._compare([[And(r0, r0, v), Add(r1, r0, 1)]
+                           for v in range(-2, 3)])
+            self._compare([[And(r0, r0, 0), Add(r1, r0, v), Add(r2, r2, 1)]
+                           for v in range(3)])
+            self._compare([[Br("z", "l"), Label("l")]] * 2)
+
+        def test_and_with_zero(self):
+            self._compare([[And(r1, r1, 0), Add(r1, r1, v), And(r0, r2, r1)]
+                           for v in range(-2, 3)])
+
+        def test_overflow(self):
+            self._compare([[And(r0, r0, 0), Add(r0, r0, v)] +
+                           [Add(r0, r0, r0)] * 70 for v in range(3)])
+
+        def test_mixed_shapes(self):
+            self._compare([self._countdown(3, -1), [And(r0, r0, 0)],
+                           self._countdown(5, -1), [Br("", "missing")]])
+
+        def test_subclasses(self):
+            # run by their own run, not by the lanes
+            class Wrapping(State):
+                def run(self):
+                    State.run(self)
+                    self.values[1] &= 7
+
+            # r1 is 6 and 12
+            states = [Wrapping(self._countdown(k, -1)) for k in (3, 6)]
+            states.append(Wrapping([Not(r0, r1)]))
+            errors = runStates(states)
+
+            self.assertEqual([s.registers[r1] for s in states[:2]], [6, 4])
+            self.assertEqual([type(e) for e in errors],
+                             [type(None), type(None),
+                              NotInitialisedRegisterError])
+
+    unittest.main()
@@ -0,0 +1,425 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+import subprocess
+import collections
+
+from customprog import (CustomProg, State, normalizeRegister, And, Add, Br,
+                        Label)
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# baseline of the micro benchmarks, kept in the repository
+baselineFilename = os.path.join(here, 'bench', 'baseline.json')
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+# name: function of the options, which returns (run, units): run does
+# the work once, units is what it processed, for the rates
+benchmarks = collections.OrderedDict()
+
+
+def benchmark(name, macro=False):
+    def register(f):
+        f.macro = macro
+        benchmarks[name] = f
+        return f
+
+    return register
+
+
+def _load(r, value):
+    # immediates are at most 15
+    instrs = [And(r, r, 0)]
+    while value > 0:
+        instrs.append(Add(r, r, min(value, 15)))
+        value -= min(value, 15)
+
+    return instrs
+
+
+def _loopInstructions():
+    # two nested countdowns, about 70000 instructions
+    instrs = _load("temp_0", 225)
+    instrs += [Label("outer")]
+    instrs += _load("temp_1", 100)
+    instrs += [Label("inner"),
+               Add("temp_1", "temp_1", -1),
+               Add("temp_2", "temp_1", 0),
+               Br("p", "inner"),
+               Add("temp_0", "temp_0", -1),
+               Br("p", "outer")]
+
+    return instrs
+
+
+@benchmark('state_loop')
+def stateLoop(options):
+    return _runStates(_loopInstructions(), options.scale)
+
+
+@benchmark('lc3_loop')
+def lc3Loop(options):
+    # state_loop as LC-3 machine code
+    from lc3 import LC3State
+
+    instrs = _loopInstructions()
+    _, units = _runStates(instrs, options.scale)
+
+    def run():
+        for _ in range(options.scale):
+            LC3State(instrs).run()
+
+    return run, units
+
+
+@benchmark('br_dispatch')
+def brDispatch(options):
+    # every condition taken and not taken, each branch jumping to the
+    # next instruction, about 1500 instructions run 20 times
+    instrs = [And("temp_0", "temp_0", 0)]
+    conditions = ["", "nzp", "n", "nz", "z", "zp", "p", "np"]
+    for k in range(500):
+        label = "l%d" % k
+        instrs.append(Add("temp_0", "temp_0", k % 3 - 1))
+        instrs.append(Br(conditions[k % len(conditions)], label))
+        instrs.append(Label(label))
+
+    return _runStates(instrs, 20 * options.scale)
+
+
+def _runStates(instrs, scale):
+    state = State(instrs)
+    state.run()
+    executed = state.executed
+    program = state.program
+
+    def run():
+        for _ in range(scale):
+            State(instrs, program=program).run()
+
+    return run, executed * scale
+
+
+@benchmark('customprog_add')
+def customprogAdd(options):
+    # what a visitor emits most: registers and immediates as strings
+    operands = [("temp_%d" % k, "temp_%d" % (k + 1), "#%d" % (k % 16))
+                for k in range(1000)]
+    operands += [("temp_%d" % k, " temp_%d " % k, "temp_%d" % (k + 2))
+                 for k in range(1000)]
+
+    def run():
+        for _ in range(options.scale):
+            prog = CustomProg()
+            for dr, sr1, sr2 in operands:
+                prog.addInstructionADD(dr, sr1, sr2)
+
+    return run, len(operands) * options.scale
+
+
+@benchmark('normalize_register')
+def normalizeRegisters(options):
+    operands = ["temp_12", " temp_3", "#7", "15", 4, "-3", "l_while_end_1"]
+    operands = operands * 300
+
+    def run():
+        for _ in range(options.scale):
+            for r in operands:
+                normalizeRegister(r)
+
+    return run, len(operands) * options.scale
+
+
+# prefix of the result line printed by test.py, see test.writeResults
+recordPrefix = 'RESULT_RECORD '
+
+
+def grades(stdout):
+    # [ok, not implemented, bugs] of the last result line of test.py,
+    # from its TotalOk ("ok / tests"), TotalNotImplemented and TotalBug
+    record = None
+    for line in stdout.decode('utf8', 'replace').split('\n'):
+        if line.startswith(recordPrefix):
+            record = json.loads(line[len(recordPrefix):])
+
+    if record is None:
+        return None
+
+    row = dict(zip(record['header'], record['row']))
+
+    return [int(str(row['TotalOk']).split('/')[0]),
+            int(row['TotalNotImplemented']), int(row['TotalBug'])]
+
+
+def _testSuite(fast):
+    # the whole test.py with the visitor of options.reference, in a
+    # python of its own as the grading does. test.py exits with 0 even
+    # when tests fail: every run must grade as the first one, and as
+    # options.expect when given
+    def make(options):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = options.reference
+        env['RESULT_RECORD'] = '1'
+        env.pop('FAST', None)
+        if fast:
+            env['FAST'] = str(fast)
+
+        expected = [getattr(options, 'expect', None)]
+
+        def run():
+            with open(os.devnull, 'w') as devnull:
+                proc = subprocess.Popen([options.python,
+                                         os.path.join(here, 'test.py')],
+                                        env=env, cwd=here,
+                                        stdout=subprocess.PIPE,
+                                        stderr=devnull)
+                stdout, _ = proc.communicate()
+            if proc.returncode != 0:
+                # a crash would be timed as a fast run
+                raise BenchmarkError('test.py exited with %d'
+                                     % proc.returncode)
+
+            result = grades(stdout)
+            if result is None:
+                raise BenchmarkError('test.py printed no result')
+            if expected[0] is None:
+                expected[0] = result
+            elif result != expected[0]:
+                raise BenchmarkError('graded %s instead of %s'
+                                     % (_formatGrades(result),
+                                        _formatGrades(expected[0])))
+
+            return result
+
+        return run, 1
+
+    return make
+
+
+def _formatGrades(grades):
+    return '%d ok, %d not implemented, %d bugs' % tuple(grades)
+
+benchmark('test_fast', macro=True)(_testSuite(10))
+benchmark('test_exhaustive', macro=True)(_testSuite(None))
+
+
+def measure(name, options):
+    # best time over options.repeat runs, in seconds
+    run, units = benchmarks[name](options)
+    result = run()
+
+    times = timeit.repeat(run, number=1, repeat=options.repeat)
+    best = min(times)
+
+    measured = {'seconds': best, 'units': units,
+                'rate': units / best if best > 0 else float('inf')}
+    if result is not None:
+        # grades of the macro benchmarks
+        measured['grades'] = result
+
+    return measured
+
+
+def compare(results, baseline, threshold):
+    # lines describing each benchmark against the baseline, and the names
+    # of those slower than it by more than threshold (0.1 is 10%)
+    lines = []
+    regressions = []
+
+    for name in results:
+        seconds = results[name]['seconds']
+        if name not in baseline:
+            lines.append('%-20s %9.4fs (no baseline)' % (name, seconds))
+            continue
+
+        before = baseline[name]['seconds']
+        change = seconds / before - 1 if before > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        elif results[name].get('grades') != baseline[name].get('grades'):
+            # timing a suite which grades differently means nothing
+            regressions.append(name)
+            flag = '  GRADES CHANGED'
+
+        lines.append('%-20s %9.4fs %9.4fs %+7.1f%%%s' %
+                     (name, before, seconds, 100 * change, flag))
+
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the harness, against stored baselines")
+    parser.add_argument('names', nargs='*',
+                        help="benchmarks to run, all the micro ones by default "
+                             "or with 'all', and the macro ones with "
+                             "--reference")
+    parser.add_argument('--reference',
+                        help="directory of a reference visitor, runs the "
+                             "macro benchmarks with it")
+    parser.add_argument('--python', default=sys.executable,
+                        help="python of the macro benchmarks")
+    parser.add_argument('--expect', metavar='OK,NOTIMPL,BUG',
+                        type=lambda s: [int(n) for n in s.split(',')],
+                        help="grades of the reference visitor, the macro "
+                             "benchmarks fail otherwise")
+    parser.add_argument('--scale', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', metavar='JSON',
+                        help="stores the results as a baseline, "
+                             "e.g. bench/baseline.json")
+    parser.add_argument('--compare', metavar='JSON', nargs='?',
+                        const=baselineFilename,
+                        help="compares the results to a baseline, "
+                             "bench/baseline.json by default")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="slowdown flagged as a regression (default 10%%)")
+    args = parser.parse_args()
+
+    names = args.names
+    if names in ([], ['all']):
+        names = [name for name, f in benchmarks.items()
+                 if not f.macro or args.reference]
+    for name in names:
+        if name not in benchmarks:
+            parser.error('unknown benchmark %s' % name)
+        if benchmarks[name].macro and not args.reference:
+            parser.error('%s needs --reference' % name)
+
+    results = collections.OrderedDict()
+    for name in names:
+        try:
+            results[name] = measure(name, args)
+        except BenchmarkError as e:
+            print('%s failed: %s' % (name, e), file=sys.stderr)
+            sys.exit(1)
+        print('%-20s %9.4fs %12.0f/s' % (name, results[name]['seconds'],
+                                         results[name]['rate']),
+              file=sys.stderr)
+
+    if args.save:
+        directory = os.path.dirname(args.save)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'scale': args.scale,
+                       'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if baseline.get('scale') != args.scale:
+            print('warning: baseline of scale %s' % baseline.get('scale'),
+                  file=sys.stderr)
+
+        lines, regressions = compare(results, baseline['results'],
+                                     args.threshold)
+        for line in lines:
+            print(line)
+
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    # without arguments, runs its tests
+    if len(sys.argv) > 1:
+        main()
+        sys.exit()
+
+    import shutil
+    import tempfile
+    import unittest
+
+    class Options:
+        scale = 1
+        repeat = 1
+
+    class Test(unittest.TestCase):
+        def test_micro(self):
+            for name, f in benchmarks.items():
+                if not f.macro:
+                    result = measure(name, Options())
+                    self.assertGreater(result['units'], 0)
+
+        def test_compare(self):
+            baseline = {'a': {'seconds': 1.0}, 'b': {'seconds': 1.0}}
+            results = collections.OrderedDict([('a', {'seconds': 1.05}),
+                                               ('b', {'seconds': 1.5}),
+                                               ('c', {'seconds': 1.0})])
+
+            lines, regressions = compare(results, baseline, 0.1)
+            self.assertEqual(regressions, ['b'])
+            self.assertEqual(len(lines), 3)
+            self.assertIn('no baseline', lines[2])
+
+            baseline['a']['grades'] = [115, 0, 0]
+            results['a']['grades'] = [114, 0, 1]
+            lines, regressions = compare(results, baseline, 0.1)
+            self.assertEqual(regressions, ['a', 'b'])
+            self.assertIn('GRADES CHANGED', lines[0])
+
+        def test_grades(self):
+            record = {'header': ['TotalOk', 'TotalNotImplemented',
+                                 'TotalBug', ''],
+                      'row': ['10 / 115', 101, 4, '']}
+            stdout = ('test output\n' + recordPrefix +
+                      json.dumps(record) + '\n').encode('utf8')
+
+            self.assertEqual(grades(stdout), [10, 101, 4])
+            self.assertEqual(grades(b'no record\n'), None)
+
+        def _suite(self, stdout, expect=None):
+            # test_fast with a python which only prints stdout
+            directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, directory)
+            python = os.path.join(directory, 'python')
+            with open(python, 'w') as f:
+                f.write('#!/bin/sh\ncat <<"EOF"\n%s\nEOF\n' % stdout)
+            os.chmod(python, 0o755)
+
+            options = Options()
+            options.reference = directory
+            options.python = python
+            options.expect = expect
+            run, _ = benchmarks['test_fast'](options)
+
+            return run
+
+        def test_graded_suite(self):
+            record = recordPrefix + json.dumps(
+                {'header': ['TotalOk', 'TotalNotImplemented', 'TotalBug'],
+                 'row': ['10 / 115', 101, 4]})
+
+            self.assertEqual(self._suite(record)(), [10, 101, 4])
+            self.assertEqual(self._suite(record, [10, 101, 4])(),
+                             [10, 101, 4])
+            with self.assertRaises(BenchmarkError):
+                self._suite(record, [115, 0, 0])()
+            with self.assertRaises(BenchmarkError):
+                # all the tests failing before the result line
+                self._suite('Traceback')()
+
+        def test_failed_suite(self):
+            options = Options()
+            options.reference = os.path.join(here, 'missing')
+            options.python = sys.executable
+            run, _ = benchmarks['test_fast'](options)
+
+            with self.assertRaises(BenchmarkError):
+                run()
+
+    unittest.main()
@@ -0,0 +1,300 @@
+from __future__ import print_function
+
+from customprog import (State, fingerprintWeight, OP_LABEL, OP_AND, OP_ADD, OP_NOT, OP_BR,
+                        N, Z, P, ALWAYS)
+
+
+# python conditions on the last written register, by NZP mask
+_conditions = {N: "%s < 0",
+               N | Z: "%s <= 0",
+               Z: "%s == 0",
+               Z | P: "%s >= 0",
+               P: "%s > 0",
+               N | P: "%s != 0"}
+
+
+def splitBlocks(program):
+    # a block starts at the first instruction, at each Label and just
+    # after each Br, so it is straight code ending by at most one Br
+    leaders = set([0])
+
+    for idx, op in enumerate(program.ops):
+        if op == OP_LABEL:
+            leaders.add(idx)
+        elif op == OP_BR:
+            leaders.add(idx + 1)
+
+    leaders = sorted(l for l in leaders if l < len(program.ops))
+
+    return list(zip(leaders, leaders[1:] + [len(program.ops)]))
+
+
+class _BlockWriter:
+    def __init__(self):
+        self.loads = []
+        self.body = []
+        # register slot -> local variable holding its current value
+        self.locals = {}
+        self.written = []
+        self.last = None
+
+    def newvar(self):
+        return 'v%d' % (len(self.loads) + len(self.body))
+
+    def read(self, slot):
+        if slot not in self.locals:
+            var = self.newvar()
+            # an uninitialised register is None, and makes the block
+            # raise TypeError before anything is written back,
+            # see CompiledState.run
+            self.loads.append('%s = R[%d]' % (var, slot))
+            self.locals[slot] = var
+
+        return self.locals[slot]
+
+    def write(self, slot, expr):
+        var = self.newvar()
+        self.body.append('%s = %s' % (var, expr))
+        self.locals[slot] = var
+        if slot not in self.written:
+            self.written.append(slot)
+        self.last = var
+
+    def source(self, name, program, start, end, fingerprint=False):
+        for pc in range(start, end):
+            op = program.ops[pc]
+            dr, sr1, sr2 = program.dr[pc], program.sr1[pc], program.sr2[pc]
+
+            if op in (OP_AND, OP_ADD):
+                operand = repr(sr2) if program.imm[pc] else self.read(sr2)
+
+            if op == OP_AND:
+                if program.imm[pc] and sr2 == 0:
+                    # And does not need sr1 in that case
+                    self.write(dr, '0')
+                else:
+                    self.write(dr, '%s & %s' % (self.read(sr1), operand))
+            elif op == OP_ADD:
+                self.write(dr, '%s + %s' % (self.read(sr1), operand))
+            elif op == OP_NOT:
+                self.write(dr, '~%s' % self.read(sr1))
+
+        lines = ['def %s(R, state):' % name]
+        lines.extend(self.loads)
+        lines.extend(self.body)
+        if fingerprint:
+            # see State.fingerprint
+            lines.extend('state.fingerprint += (%s - (R[%d] or 0)) * %d'
+                         % (self.locals[slot], slot, fingerprintWeight(slot))
+                         for slot in self.written)
+        lines.extend('R[%d] = %s' % (slot, self.locals[slot])
+                     for slot in self.written)
+        if self.last is not None:
+            lines.append('state.lastRegister = %s' % self.last)
+
+        if program.ops[end - 1] == OP_BR:
+            mask = program.dr[end - 1]
+            jump = 'return %d' % program.sr1[end - 1]
+
+            if mask == ALWAYS:
+                lines.append(jump)
+            else:
+                last = self.last or 'state.getLastRegister()'
+                lines.append('if %s:' % (_conditions[mask] % last))
+                lines.append('    ' + jump)
+
+        lines.append('return %d' % end)
+
+        return '\n    '.join(lines)
+
+
+def compileBlocks(program, fingerprint=False):
+    # returns, for each pc, None or the (function, length) of the
+    # block starting there. All the blocks are exec'd at once. With
+    # fingerprint, they keep State.fingerprint up to date.
+    blocks = splitBlocks(program)
+
+    sources = []
+    for start, end in blocks:
+        sources.append(_BlockWriter().source('block_%d' % start,
+                                             program, start, end,
+                                             fingerprint))
+
+    namespace = {}
+    exec(compile('\n\n'.join(sources), '<blocks>', 'exec'), namespace)
+
+    table = [None] * len(program.ops)
+    for start, end in blocks:
+        table[start] = (namespace['block_%d' % start], end - start)
+
+    return table
+
+
+class CompiledState(State):
+    def __init__(self, instrs, maxInstructions=100000, program=None,
+                 detectLoops=False):
+        State.__init__(self, instrs, maxInstructions, program, detectLoops)
+
+        self.blocks = compileBlocks(self.program, detectLoops)
+
+    def run(self):
+        self.program.checkLinked()
+
+        blocks = self.blocks
+        values = self.values
+        count = 0
+        pc = 0
+        while pc < len(blocks):
+            function, length = blocks[pc]
+
+            if count + length > self.maxInstructions:
+                # the limit is reached inside this block, let the
+                # interpreter stop on the very same instruction
+                self._interpret(pc, count)
+                return
+
+            try:
+                newPc = function(values, self)
+            except TypeError:
+                # an uninitialised register was read, nothing was written
+                # back yet: replay the block to get the exact error
+                newPc = self._interpret(pc, count, count + length)
+            else:
+                if self.detectLoops and newPc < pc + length:
+                    self._backEdge(pc + length - 1, self.lastRegister,
+                                   self.fingerprint)
+
+            pc = newPc
+            count += length
+            self.executed = count
+
+if __name__ == '__main__':
+    import unittest
+
+    from customprog import (Label, And, Add, Not, Br, InfiniteLoopError,
+                            MissingLabelError, NotInitialisedRegisterError)
+
+    r0 = "temp_0"
+    r1 = "temp_1"
+    r2 = "temp_2"
+
+    class Test(unittest.TestCase):
+        def _compare(self, instrs, maxInstructions=100000, detectLoops=False):
+            results = []
+            executed = []
+            fingerprints = []
+            for cls in [State, CompiledState]:
+                state = cls(instrs, maxInstructions, detectLoops=detectLoops)
+                try:
+                    state.run()
+                    error = None
+                except Exception as e:
+                    error = type(e)
+
+                results.append((error, state.registers, state.lastRegister))
+                executed.append(state.executed)
+                fingerprints.append(state.fingerprint)
+
+            self.assertEqual(results[0], results[1])
+            if results[0][0] is None:
+                self.assertEqual(executed[0], executed[1])
+            if detectLoops:
+                self.assertEqual(fingerprints[0], fingerprints[1])
+
+            return results[1]
+
+        def test_straight(self):
+            error, registers, last = self._compare([
+                And(r0, r0, 0),
+                Add(r0, r0, 5),
+                Not(r1, r0),
+                Add(r2, r0, r1),
+                And(r2, r2, 3)])
+
+            self.assertEqual(registers, {r0: 5, r1: -6, r2: 3})
+            self.assertEqual(last, 3)
+
+        def test_branching(self):
+            for v in range(-3, 4):
+                instrs = []
+                for test in ["", "n", "nz", "z", "zp", "p", "np", "nzp"]:
+                    instrs.extend([And(r0, r0, 0),
+                                   Add(r0, r0, v),
+                                   Br(test, "l" + test),
+                                   And("r" + test, "r" + test, 0),
+                                   Label("l" + test)])
+
+                self._compare(instrs)
+
+        def test_loop(self):
+            # r1 = 4 * 3
+            error, registers, last = self._compare([
+                And(r0, r0, 0),
+                Add(r0, r0, 3),
+                And(r1, r1, 0),
+                Label("loop"),
+                Add(r1, r1, 4),
+                Add(r0, r0, -1),
+                Br("p", "loop")])
+
+            self.assertEqual(registers[r1], 12)
+
+        def test_infinite_loop(self):
+            for maxInstructions in range(1, 12):
+                error, _, _ = self._compare([
+                    And(r0, r0, 0),
+                    Label("start"),
+                    Add(r0, r0, 1),
+                    Br("", "start")], maxInstructions)
+
+                self.assertEqual(error, InfiniteLoopError)
+
+        def test_detect_loops(self):
+            error, _, _ = self._compare([
+                And(r0, r0, 0),
+                Label("start"),
+                Add(r0, r0, 1),
+                And(r0, r0, 7),
+                Br("", "start")], 10 ** 9, detectLoops=True)
+
+            self.assertEqual(error, InfiniteLoopError)
+
+            error, _, _ = self._compare([
+                And(r0, r0, 0), Add(r0, r0, 9),
+                Label("start"),
+                Add(r1, r0, r0),
+                Add(r0, r0, -1),
+                Br("p", "start")], detectLoops=True)
+
+            self.assertEqual(error, None)
+
+        def test_limit_on_last_instruction(self):
+            for maxInstructions in range(1, 5):
+                self._compare([And(r0, r0, 0), Add(r0, r0, 1), Label("end")],
+                              maxInstructions)
+
+        def test_missing_label(self):
+            error, _, _ = self._compare([And(r0, r0, 0), Br("z", "missing")])
+            self.assertEqual(error, MissingLabelError)
+
+            error, _, _ = self._compare([And(r0, r0, 0), Br("n", "missing")])
+            self.assertEqual(error, MissingLabelError)
+
+        def test_notinitialised(self):
+            for instrs in [[Not(r0, r0)],
+                           [And(r0, r0, 2)],
+                           [And(r0, r0, 0), Add(r0, r0, r1)],
+                           [And(r1, r1, 0), Add(r2, r2, 1), Add(r1, r1, 1)],
+                           [Br("z", "l"), Label("l")]]:
+                error, _, _ = self._compare(instrs)
+                self.assertEqual(error, NotInitialisedRegisterError)
+
+        def test_and_uninitialised_with_zero(self):
+            error, registers, _ = self._compare([
+                And(r1, r1, 0),
+                And(r0, r2, r1)])
+
+            self.assertEqual(error, None)
+            self.assertEqual(registers, {r0: 0, r1: 0})
+
+    unittest.main()
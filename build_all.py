@@ -1,73 +1,360 @@
+import csv
 import glob
-import sys
+import hashlib
 import os
+import json
+import signal
+import argparse
+import asyncio
 import subprocess
+import tempfile
 
 antlrpath = '/home/guillaume/teaching/compil_ucbl_2016/lib/antlr-4.5.3-complete.jar'
 
+# prefix of the result line printed by test.py, see test.writeResults
+recordPrefix = 'RESULT_RECORD '
 
-def antl_command(path):
-    currentDir = os.getcwd()
 
-    os.chdir(os.path.dirname(path))
-    cmd = ["java", "-jar", antlrpath, "Mu.g4", "-Dlanguage=Python2", "-visitor", "-no-listener"]
+antlrOptions = ["-Dlanguage=Python2", "-visitor", "-no-listener"]
+# files generated next to each Mu.g4
+antlrOutputs = ['MuLexer.py', 'MuParser.py', 'MuVisitor.py']
+antlrStamp = 'Mu.g4.stamp'
 
-    # print(' '.join(cmd))
-    subprocess.check_call(cmd)
 
-    os.chdir(currentDir)
+def fileHash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def isGenerated(g4, stamp):
+    # the outputs are up to date if they were generated from the same
+    # grammar, by the same version of ANTLR, with the same options
+    dir = os.path.dirname(g4)
+    if not all(os.path.exists(os.path.join(dir, name)) for name in antlrOutputs):
+        return False
 
-def test_command(path, flog):
     try:
-        (stdout, stderr) = subprocess.Popen("FAST=10 PYTHONPATH='%s' python2 test.py -q" % path,
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.PIPE,
-                                            shell=True).communicate()
+        with open(os.path.join(dir, antlrStamp)) as f:
+            return json.load(f) == stamp
+    except (IOError, ValueError):
+        return False
+
+
+def antlr_driver():
+    # compiles AntlrBatch.java, which runs ANTLR on many grammars in one JVM
+    here = os.path.dirname(os.path.abspath(__file__))
+    source = os.path.join(here, 'AntlrBatch.java')
+    classes = os.path.join(here, 'antlrbatch')
+
+    compiled = os.path.join(classes, 'AntlrBatch.class')
+    if not os.path.exists(compiled) or os.path.getmtime(compiled) < os.path.getmtime(source):
+        os.makedirs(classes, exist_ok=True)
+        subprocess.check_call(["javac", "-cp", antlrpath, "-d", classes, source])
+
+    return classes
+
+
+def antl_generate(g4s, jobs):
+    # Runs ANTLR on the grammars which changed since their last
+    # generation, split over at most jobs JVMs
+    antlrVersion = fileHash(antlrpath)
+    stamps = dict((g4, {'g4': fileHash(g4), 'antlr': antlrVersion,
+                        'options': antlrOptions}) for g4 in g4s)
+
+    stale = [g4 for g4 in g4s if not isGenerated(g4, stamps[g4])]
+    print(len(g4s) - len(stale), 'grammars are up to date')
+
+    if not stale:
+        return
+
+    classpath = antlrpath + os.pathsep + antlr_driver()
+
+    procs = []
+    for k in range(min(jobs, len(stale))):
+        procs.append(subprocess.Popen(["java", "-cp", classpath, "AntlrBatch"] + antlrOptions + stale[k::jobs],
+                                      stdout=subprocess.PIPE, universal_newlines=True))
+
+    for proc in procs:
+        for line in proc.stdout:
+            if line.startswith('generated '):
+                g4 = line[len('generated '):].rstrip('\n')
+                with open(os.path.join(os.path.dirname(g4), antlrStamp), 'w') as f:
+                    json.dump(stamps[g4], f)
+            else:
+                print(line, end='')
+
+        proc.wait()
+
+
+def harnessVersion():
+    # hash of the grading code run by the students, a result is out of
+    # date as soon as any of it changes
+    h = hashlib.sha1()
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+        if os.path.basename(filename) != 'build_all.py':
+            with open(filename, 'rb') as f:
+                h.update(hashlib.sha1(f.read()).digest())
+
+    return h.hexdigest()
+
+
+def contentHash(path):
+    # hash of the files of a student, ignoring the compiled python files
+    # written while grading
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for name in sorted(files):
+            if name.endswith(('.pyc', '.pyo')):
+                continue
+
+            filename = os.path.join(root, name)
+            h.update(os.path.relpath(filename, path).encode('utf8') + b'\0')
+            with open(filename, 'rb') as f:
+                h.update(hashlib.sha1(f.read()).digest())
+
+    return h.hexdigest()
+
+
+class Manifest:
+    # Result of each grammar, by its directory relative to the correction
+    # path, with the hash of its files and the harness version it was
+    # graded with. It is saved after every student, so an interrupted run
+    # resumes where it stopped, and students whose files did not change
+    # are not graded again.
+    def __init__(self, filename, harness):
+        self.filename = filename
+        self.harness = harness
+        self.entries = {}
+
+        if os.path.exists(filename):
+            with open(filename) as f:
+                data = json.load(f)
+            self.entries = data.get('grammars', {})
+
+    def isCurrent(self, key, digest):
+        # the timeouts and the failures are graded again
+        entry = self.entries.get(key)
+        return (entry is not None and entry['hash'] == digest
+                and entry['harness'] == self.harness
+                and isinstance(entry['record'], dict))
+
+    def update(self, key, digest, record):
+        self.entries[key] = {'hash': digest, 'harness': self.harness,
+                             'record': record}
+        self.save()
+
+    def save(self):
+        # written to a temporary file then renamed, a crash never leaves
+        # a partial manifest
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'grammars': self.entries}, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+
+def parseRecord(stdout):
+    # the last record line wins, student code may print anything before
+    record = None
+    for line in stdout.decode('utf8', 'replace').split('\n'):
+        if line.startswith(recordPrefix):
+            record = json.loads(line[len(recordPrefix):])
+
+    return record
+
 
-        flog.write(stdout)
-        flog.write(stderr)
+async def test_command(path, semaphore, timeout):
+    # returns (record, stdout, stderr) of the tests of one student,
+    # record is None on failure and 'TIMEOUT' when the student was killed
+    env = dict(os.environ, FAST='10', PYTHONPATH=path, RESULT_RECORD='1')
 
-        errors = list(filter(lambda x: 'Error:' in x, stderr.decode('utf8').split('\n')))
+    async with semaphore:
+        # in its own session, so that the whole process group is killed
+        proc = await asyncio.create_subprocess_exec(
+            "python2", "test.py", "-q",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            start_new_session=True)
+
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                # the group ended meanwhile
+                pass
+            await proc.wait()
+
+            return 'TIMEOUT', b'', ('TIMEOUT after %ds\n' % timeout).encode('utf8')
+
+    return parseRecord(stdout), stdout, stderr
+
+
+async def fork_command(path, semaphore, timeout, server):
+    # same as test_command, but the student process is forked by the
+    # fork server, see forkserver.py
+    async with semaphore:
+        # the reply holds the whole output of the student
+        reader, writer = await asyncio.open_unix_connection(server, limit=2 ** 26)
+        writer.write((json.dumps({'path': path, 'env': {'FAST': '10'}}) + '\n').encode('utf8'))
+
+        pid = None
+        try:
+            async def communicate():
+                nonlocal pid
+                pid = json.loads(await reader.readline())['pid']
+                return json.loads(await reader.readline())
+
+            reply = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            if pid is not None:
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+            return 'TIMEOUT', b'', ('TIMEOUT after %ds\n' % timeout).encode('utf8')
+        except ValueError:
+            # the student process died without answering
+            return None, b'', b''
+        finally:
+            writer.close()
+
+    return reply['record'], reply['stdout'].encode('utf8'), reply['stderr'].encode('utf8')
+
+
+async def start_server(directory):
+    # the server preloads the shared modules once, then forks a process
+    # per student
+    server = os.path.join(directory, 'forkserver.sock')
+    proc = await asyncio.create_subprocess_exec(
+        "python2", "forkserver.py", server,
+        stdout=subprocess.PIPE)
+
+    if (await proc.stdout.readline()).strip() != b'ready':
+        raise RuntimeError('the fork server did not start')
+
+    return proc, server
+
+
+async def test_all(dirs, manifest, jobs, timeout, forkServer=False):
+    semaphore = asyncio.Semaphore(jobs)
+
+    if forkServer:
+        directory = tempfile.mkdtemp()
+        proc, server = await start_server(directory)
+
+    async def test_one(key, name, dir, digest):
+        if forkServer:
+            result = await fork_command(dir, semaphore, timeout, server)
+        else:
+            result = await test_command(dir, semaphore, timeout)
+
+        print(name)
+        errors = list(filter(lambda x: 'Error:' in x, result[2].decode('utf8', 'replace').split('\n')))
         errors.sort()
         for i in errors:
             if not i.startswith('AssertionError'):
                 print('\t', i)
 
-        return True
-    except subprocess.CalledProcessError:
-        return False
+        manifest.update(key, digest, result[0])
+
+        return result
+
+    try:
+        return await asyncio.gather(*[test_one(*student) for student in dirs])
+    finally:
+        if forkServer:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+            os.remove(server)
+            os.rmdir(directory)
+
 
-correction_path = os.path.realpath(sys.argv[1])
+def main():
+    parser = argparse.ArgumentParser(description="Grades all the students")
+    parser.add_argument('correction_path')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--timeout', type=int, default=600,
+                        help="wall-clock seconds per student")
+    parser.add_argument('--generate', action='store_true',
+                        help="run ANTLR on the grammars which changed, instead of grading")
+    parser.add_argument('--manifest', default='manifest.json',
+                        help="results of the previous runs")
+    parser.add_argument('--force', action='store_true',
+                        help="grade again the students already in the manifest")
+    parser.add_argument('--fork-server', action='store_true',
+                        help="fork the students from a python2 process which "
+                        "has already imported antlr4 and the harness")
+    args = parser.parse_args()
 
-g4s = glob.glob(os.path.join(correction_path, "**/Mu.g4"), recursive=True)
+    correction_path = os.path.realpath(args.correction_path)
 
-print(len(g4s))
+    g4s = sorted(glob.glob(os.path.join(correction_path, "**/Mu.g4"), recursive=True))
 
-generateG4 = False
+    print(len(g4s))
 
-with open("allResult.csv", "w") as fResult, open('logs', 'wb') as flog:
-    headerOk = False
+    if args.generate:
+        antl_generate(g4s, args.jobs)
+        return
+
+    dirs = []
     for g4 in g4s:
         dir = os.path.dirname(g4)
 
-        name = '/'.join(dir[len(correction_path) + 1:].split('/')[:2])
-        print(name)
+        key = os.path.relpath(dir, correction_path)
+        name = '/'.join(key.split(os.sep)[:2])
+        dirs.append((key, name, dir))
 
-        if  generateG4:
-            antl_command(g4)
-        else:
-            worked = test_command(dir, flog)
+    manifest = Manifest(args.manifest, harnessVersion())
+
+    # only the new or modified students are graded
+    todo = []
+    for key, name, dir in dirs:
+        digest = contentHash(dir)
+        if args.force or not manifest.isCurrent(key, digest):
+            todo.append((key, name, dir, digest))
 
-            if worked:
-                # copy partial result to the big file
-                with open('result.csv', 'r') as f:
-                    line1, line2, _ = f.read().split('\n')
+    print(len(dirs) - len(todo), 'students are up to date')
 
+    results = asyncio.run(test_all(todo, manifest, args.jobs, args.timeout,
+                                   args.fork_server))
+
+    # appended to, as the students up to date are not graded again
+    with open('logs', 'ab') as flog:
+        for (key, name, dir, digest), (record, stdout, stderr) in zip(todo, results):
+            flog.write(('==> %s <==\n' % name).encode('utf8'))
+            flog.write(stdout)
+            flog.write(stderr)
+
+    # written in the order of the students, whatever the order they ended
+    with open("allResult.csv", "w", newline='') as fResult:
+        writer = csv.writer(fResult)
+        headerOk = False
+        for key, name, dir in dirs:
+            record = manifest.entries[key]['record']
+
+            if record == 'TIMEOUT':
+                writer.writerow([name, ' TIMEOUT'])
+            elif record is not None:
                 if not headerOk:
-                    fResult.write("Nom," + line1 + '\n')
+                    writer.writerow(["Nom"] + record['header'])
 
                     headerOk = True
 
-                fResult.write(name + ',' + line2 + '\n')
+                writer.writerow([name] + record['row'])
             else:
-                fResult.write(name + ', MISERABLE FAILURE\n')
+                writer.writerow([name, ' MISERABLE FAILURE'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+from __future__ import print_function
+
+import os
+import errno
+import hashlib
+import pickle
+import tempfile
+
+import customprog
+
+_classes = dict((cls.__name__, cls) for cls in [customprog.Comment,
+                                                 customprog.Label,
+                                                 customprog.And,
+                                                 customprog.Add,
+                                                 customprog.Not,
+                                                 customprog.Br])
+
+
+def sourceFile(filename):
+    # modules may have been loaded from their .pyc
+    if filename.endswith(('.pyc', '.pyo')) and os.path.exists(filename[:-1]):
+        return filename[:-1]
+
+    return filename
+
+
+class CompileCache:
+    # On disk cache of the instructions emitted for a Mu source, keyed by
+    # the source and the content of the files which generate the code.
+    # Entries are written to a temporary file then renamed, so concurrent
+    # writers never expose a partial entry, and the least recently used
+    # entries are removed when the cache grows over maxBytes.
+    def __init__(self, directory, maxBytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+        self._fileDigests = {}
+        self._size = None
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _fileDigest(self, filename):
+        # hashed again when the file changed
+        st = os.stat(filename)
+        stamp = (st.st_mtime, st.st_size)
+
+        if self._fileDigests.get(filename, (None,))[0] != stamp:
+            with open(filename, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            self._fileDigests[filename] = (stamp, digest)
+
+        return self._fileDigests[filename][1]
+
+    def key(self, source, filenames):
+        h = hashlib.sha1()
+        for filename in filenames:
+            h.update(self._fileDigest(sourceFile(filename)).encode('ascii'))
+        if not isinstance(source, bytes):
+            source = source.encode('utf8')
+        h.update(source)
+
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, key):
+        path = self._path(key)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # recently used entries are the last to be evicted
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+
+        return [_classes[name](*fields) for name, fields in pickle.loads(data)]
+
+    def put(self, key, instrs):
+        data = pickle.dumps([(type(instr).__name__,
+                              tuple(getattr(instr, field)
+                                    for field in instr.__slots__))
+                             for instr in instrs], 2)
+
+        path = self._path(key)
+        try:
+            # the size of the entry it replaces
+            previous = os.path.getsize(path)
+        except OSError:
+            previous = 0
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += len(data) - previous
+
+        if self._size > self.maxBytes:
+            self.evict()
+
+    def _entries(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # removed by another process
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def evict(self):
+        # removes the least recently used entries, down to 3/4 of maxBytes
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+
+        for path, size, _ in entries:
+            if self._size <= self.maxBytes * 3 // 4:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._size -= size
+
+if __name__ == '__main__':
+    import shutil
+    import unittest
+
+    from customprog import Label, And, Add, Br
+
+    r0 = "temp_0"
+
+    class Test(unittest.TestCase):
+        instrs = [And(r0, r0, 0), Label("loop"), Add(r0, r0, 1),
+                  Br("n", "loop")]
+
+        def setUp(self):
+            self.directory = tempfile.mkdtemp()
+            self.cache = CompileCache(os.path.join(self.directory, 'cache'))
+
+        def tearDown(self):
+            shutil.rmtree(self.directory)
+
+        def _write(self, name, content):
+            filename = os.path.join(self.directory, name)
+            with open(filename, 'w') as f:
+                f.write(content)
+
+            return filename
+
+        def test_hit_miss(self):
+            visitor = self._write('visitor.py', 'a = 1\n')
+            key = self.cache.key('a = 1;', [visitor])
+
+            self.assertIsNone(self.cache.get(key))
+            self.cache.put(key, self.instrs)
+            self.assertEqual([repr(i) for i in self.cache.get(key)],
+                             [repr(i) for i in self.instrs])
+            self.assertIsNone(self.cache.get(self.cache.key('a = 2;',
+                                                            [visitor])))
+
+        def test_invalidation(self):
+            visitor = self._write('visitor.py', 'a = 1\n')
+            key = self.cache.key('a = 1;', [visitor])
+            self.assertEqual(self.cache.key(u'a = 1;', [visitor]), key)
+
+            self._write('visitor.py', 'a = 12\n')
+            self.assertNotEqual(self.cache.key('a = 1;', [visitor]), key)
+
+        def test_overwrite(self):
+            self.cache.put('a', self.instrs)
+            self.cache.put('a', self.instrs)
+            self.cache.put('a', self.instrs[:1])
+
+            self.assertEqual(self.cache._size,
+                             sum(size for _, size, _ in self.cache._entries()))
+
+        def test_eviction_order(self):
+            for k, key in enumerate(['a', 'b', 'c', 'd']):
+                self.cache.put(key, self.instrs)
+                # one second apart, oldest first
+                t = 1000000000 + k
+                os.utime(self.cache._path(key), (t, t))
+
+            # the least recently used are now b then c
+            self.cache.get('a')
+
+            size = self.cache._size // 4
+            self.cache.maxBytes = 3 * size
+            self.cache.evict()
+            self.assertEqual([key for key in 'abcd' if self.cache.get(key)],
+                             ['a', 'd'])
+
+    unittest.main()
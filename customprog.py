@@ -1,5 +1,12 @@
 from __future__ import print_function
 
+from array import array
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 
 class UnexpectedBranchingLabelError(Exception):
     pass
@@ -17,6 +24,10 @@ class TooMuchAsmError(Exception):
     pass
 
 
+class InstructionBudgetError(TooMuchAsmError):
+    pass
+
+
 class NotStringLabelError(Exception):
     pass
 
@@ -32,10 +43,19 @@ class MissingLabelError(Exception):
 class NotInitialisedRegisterError(Exception):
     pass
 
+
+class DuplicateLabelError(Exception):
+    pass
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
 def isString(s):
     return isinstance(s, (str, unicode))
 
-def normalizeRegister(r):
+def _normalizeRegister(r):
     # convert to string, this avoid the
     # case where student are passing a python object convertible to string
     r = str(r).strip()
@@ -47,9 +67,42 @@ def normalizeRegister(r):
     try:
         return int(r)
     except ValueError:
-        return r # as a string
+        return intern(r) # as a string
+
+# normalizeRegister of the strings already seen: visitors use the same
+# few registers, labels and constants over and over
+_normalized = {}
+
+def normalizeRegister(r):
+    if type(r) is str:
+        try:
+            return _normalized[r]
+        except KeyError:
+            pass
+
+        result = _normalizeRegister(r)
+        if len(_normalized) < 100000:
+            _normalized[r] = result
+        return result
+    elif type(r) is int:
+        return r
+
+    return _normalizeRegister(r)
+
+# conditions of Br
+branchConditions = frozenset([frozenset(), frozenset("nzp"), frozenset("nz"),
+                              frozenset("zp"), frozenset("n"), frozenset("p"),
+                              frozenset("np"), frozenset("z")])
 
 class CustomProg:
+    # maximum number of instructions, lower than the 100000 of
+    # TooMuchAsmError, set by the grading
+    budget = None
+
+    # when set, operands and conditions are only checked by validate,
+    # once all the instructions are emitted
+    deferValidation = False
+
     def __init__(self):
         self._listIns = []
         self._nbtmp = 0
@@ -78,22 +131,39 @@ class CustomProg:
 
     def _addInstr(self, instr):
         if len(self._listIns) > 100000:
-            raise TooMuchAsmError()
+            error = TooMuchAsmError()
+        elif self.budget is not None and len(self._listIns) >= self.budget:
+            error = InstructionBudgetError(self.budget)
         else:
             self._listIns.append(instr)
+            return
+
+        if self.deferValidation:
+            # instr was checked before being added
+            self._fail(error, instr)
+        raise error
+
+    def _fail(self, error, instr=None):
+        # in the deferred mode, the first invalid instruction added before
+        # is reported instead, as it would have been when it was added
+        if self.deferValidation:
+            self.validate()
+            if instr is not None:
+                self._validateInstruction(instr)
+        raise error
 
     def addLabel(self, s):
         if not isString(s):
-            raise NotStringLabelError(repr(s))
+            self._fail(NotStringLabelError(repr(s)))
 
         self._addInstr(Label(s))
 
     def addInstructionBR(self, s, label):
-        s2 = frozenset(s)
-        if s2 not in [frozenset(), frozenset("nzp"), frozenset("nz"), frozenset("zp"),
-                      frozenset("n"), frozenset("p"), frozenset("np"), frozenset("z")]:
-            raise UnexpectedBranchingLabelError(repr(s))
-        self._addInstr(Br(s, label))
+        # checked in both modes, Br builds the frozenset anyway
+        instr = Br(s, label)
+        if instr.s not in branchConditions:
+            self._fail(UnexpectedBranchingLabelError(repr(s)))
+        self._addInstr(instr)
 
     def addInstructionGOTO(self, label):
         self._addInstr(Br("", label))
@@ -102,8 +172,9 @@ class CustomProg:
         dr = normalizeRegister(dr)
         sr1 = normalizeRegister(sr1)
 
-        self._assertIsRegister(dr)
-        self._assertIsRegister(sr1)
+        if not self.deferValidation:
+            self._assertIsRegister(dr)
+            self._assertIsRegister(sr1)
 
         self._addInstr(Not(dr, sr1))
 
@@ -112,9 +183,10 @@ class CustomProg:
         sr1 = normalizeRegister(sr1)
         sr2orimm7 = normalizeRegister(sr2orimm7)
 
-        self._assertIsRegister(dr)
-        self._assertIsRegister(sr1)
-        self._assertIsRegisterOrInt(sr2orimm7)
+        if not self.deferValidation:
+            self._assertIsRegister(dr)
+            self._assertIsRegister(sr1)
+            self._assertIsRegisterOrInt(sr2orimm7)
 
         self._addInstr(Add(dr, sr1, sr2orimm7))
 
@@ -123,12 +195,43 @@ class CustomProg:
         sr1 = normalizeRegister(sr1)
         sr2orimm7 = normalizeRegister(sr2orimm7)
 
-        self._assertIsRegister(dr)
-        self._assertIsRegister(sr1)
-        self._assertIsRegisterOrInt(sr2orimm7)
+        if not self.deferValidation:
+            self._assertIsRegister(dr)
+            self._assertIsRegister(sr1)
+            self._assertIsRegisterOrInt(sr2orimm7)
 
         self._addInstr(And(dr, sr1, sr2orimm7))
 
+    # checks of the deferred mode: raises what the first invalid
+    # instruction would have raised when it was added
+    def validate(self):
+        for instr in self._listIns:
+            self._validateInstruction(instr)
+
+    def _validateInstruction(self, instr):
+        op = instr.opcode
+        if op == OP_AND or op == OP_ADD:
+            if not (self._isRegister(instr.dr) and
+                    self._isRegister(instr.sr1)):
+                self._assertIsRegister(instr.dr)
+                self._assertIsRegister(instr.sr1)
+            sr2 = instr.sr2orimm7
+            if type(sr2) is not int or not self._isRightSizedInt(sr2):
+                self._assertIsRegisterOrInt(sr2)
+        elif op == OP_NOT:
+            self._assertIsRegister(instr.dr)
+            self._assertIsRegister(instr.sr1)
+
+    # links the program, and raises on missing or duplicate labels
+    def finalize(self):
+        if self.deferValidation:
+            self.validate()
+
+        program = Program(self._listIns)
+        program.checkLinked()
+
+        return program
+
     def printCode(self, filename):
         pass
 
@@ -163,36 +266,58 @@ class CustomProg:
                 raise OverflowConstantError(repr(int_value))
 
 
-class Show:
+class Show(object):
+    __slots__ = ()
+
     def __repr__(self):
         def formatdict(d):
             return ', '.join(("%s=%r" % (key, val))
                              for key, val in sorted(d.items()))
 
         return "{}({})".format(self.__class__.__name__,
-                               formatdict(self.__dict__))
+                               formatdict(dict((key, getattr(self, key))
+                                               for key in self.__slots__)))
 
     def __str__(self):
         return repr(self)
 
+    # executes the instruction alone on the registers of a State, as
+    # before Program, and returns the pc to jump to or None. State.run
+    # executes the columns of its Program instead
+    def visit(self, state):
+        pass
+
+
+# opcodes of the compact program form
+OP_NOP, OP_LABEL, OP_AND, OP_ADD, OP_NOT, OP_BR = range(6)
+
+# pairs of instructions executed at once, only in Program.fused:
+# - LoadImm: And(r, x, 0); Add(r, r, imm)
+# - Neg: Not(r, s); Add(r, r, 1)
+# - Move: And(r, x, 0); Add(r, r, s)
+OP_LOADIMM, OP_NEG, OP_MOVE = range(6, 9)
+
 
 class Comment(Show):
+    __slots__ = ('s',)
+    opcode = OP_NOP
+
     def __init__(self, s):
         self.s = s
 
-    def visit(self, state):
-        pass
-
 
 class Label(Show):
+    __slots__ = ('label',)
+    opcode = OP_LABEL
+
     def __init__(self, label):
         self.label = label
 
-    def visit(self, state):
-        pass
-
 
 class And(Show):
+    __slots__ = ('dr', 'sr1', 'sr2orimm7')
+    opcode = OP_AND
+
     def __init__(self, dr, sr1, sr2orimm7):
         self.dr, self.sr1, self.sr2orimm7 = dr, sr1, sr2orimm7
 
@@ -212,12 +337,14 @@ class And(Show):
                 state.setRegister(self.dr, 0)
             else:
                 raise NotInitialisedRegisterError()
-
         else:
             state.setRegister(self.dr, v0 & v1)
 
 
 class Add(Show):
+    __slots__ = ('dr', 'sr1', 'sr2orimm7')
+    opcode = OP_ADD
+
     def __init__(self, dr, sr1, sr2orimm7):
         self.dr, self.sr1, self.sr2orimm7 = dr, sr1, sr2orimm7
 
@@ -227,6 +354,9 @@ class Add(Show):
 
 
 class Not(Show):
+    __slots__ = ('dr', 'sr1')
+    opcode = OP_NOT
+
     def __init__(self, dr, sr1):
         self.dr, self.sr1 = dr, sr1
 
@@ -235,44 +365,252 @@ class Not(Show):
 
 
 class Br(Show):
+    __slots__ = ('s', 'label')
+    opcode = OP_BR
+
     def __init__(self, s, label):
         self.s = frozenset(s)
         self.label = label
 
     def visit(self, state):
-        ops = {frozenset("n"): lambda x: x < 0,
-               frozenset("nz"): lambda x: x <= 0,
-               frozenset("z"): lambda x: x == 0,
-               frozenset("zp"): lambda x: x >= 0,
-               frozenset("p"): lambda x: x > 0,
-               frozenset("np"): lambda x: x != 0}
+        if self.s not in conditionMasks:
+            raise UnexpectedBranchingLabelError(repr(self.s))
+        mask = conditionMasks[self.s]
 
         # do not read the last register if
         # the branch is unconditional
-        if (self.s in {frozenset(), frozenset("nzp")} or
-           ops[self.s](state.getLastRegister())):
+        if mask == ALWAYS or mask & conditionCode(state.getLastRegister()):
             return state.getPcAtLabel(self.label)
 
         return None
 
 
-class State:
-    def __init__(self, instrs, maxInstructions=100000):
-        self.instrs = instrs
-        self.maxInstructions = maxInstructions
+# NZP masks of the branching conditions. Unconditional branches
+# are ALWAYS and do not read the last register
+N, Z, P = 4, 2, 1
+ALWAYS = N | Z | P
+
+conditionMasks = {frozenset(): ALWAYS,
+                  frozenset("nzp"): ALWAYS,
+                  frozenset("n"): N,
+                  frozenset("nz"): N | Z,
+                  frozenset("z"): Z,
+                  frozenset("zp"): Z | P,
+                  frozenset("p"): P,
+                  frozenset("np"): N | P}
 
-        # find labels offsets
+
+def conditionCode(value):
+    if value < 0:
+        return N
+    elif value == 0:
+        return Z
+    else:
+        return P
+
+
+def _column(typecode, values):
+    # values which do not fit in a machine word stay in a list
+    try:
+        return array(typecode, values)
+    except OverflowError:
+        return list(values)
+
+
+class Program(object):
+    # Instructions stored by columns, registers and labels are interned
+    # to integer slots. Operands of an instruction at pc are:
+    # - And/Add: dr[pc], sr1[pc] and sr2[pc], the latter being an
+    #   immediate value if imm[pc] is set
+    # - Not: dr[pc], sr1[pc]
+    # - Br: its NZP mask in dr[pc], the pc of its label in sr1[pc]
+    # Labels are linked when the program is built, linking errors are
+    # kept in linkError until the program is run. fused is ops with the
+    # first instruction of the fused pairs replaced by their opcode.
+    __slots__ = ('ops', 'dr', 'sr1', 'sr2', 'imm', 'fused',
+                 'registerNames', 'registerSlots', 'labels', 'linkError')
+
+    def __init__(self, instrs):
+        self.registerNames = []
+        self.registerSlots = {}
         self.labels = {}
+        self.linkError = None
 
         for idx, instr in enumerate(instrs):
             if isinstance(instr, Label):
+                if instr.label in self.labels and self.linkError is None:
+                    self.linkError = DuplicateLabelError(instr.label)
                 self.labels[instr.label] = idx
 
-        # registers
-        self.registers = {}
+        ops = []
+        drs = []
+        sr1s = []
+        sr2s = []
+        imms = []
+
+        for instr in instrs:
+            op = instr.opcode
+            dr = sr1 = sr2 = imm = 0
+
+            if op in (OP_AND, OP_ADD):
+                dr = self.intern(instr.dr)
+                sr1 = self.intern(instr.sr1)
+                if isinstance(instr.sr2orimm7, int):
+                    sr2 = instr.sr2orimm7
+                    imm = 1
+                else:
+                    sr2 = self.intern(instr.sr2orimm7)
+            elif op == OP_NOT:
+                dr = self.intern(instr.dr)
+                sr1 = self.intern(instr.sr1)
+            elif op == OP_BR:
+                if instr.s not in conditionMasks:
+                    raise UnexpectedBranchingLabelError(repr(instr.s))
+                dr = conditionMasks[instr.s]
+                if instr.label in self.labels:
+                    sr1 = self.labels[instr.label]
+                else:
+                    sr1 = -1
+                    if self.linkError is None:
+                        self.linkError = MissingLabelError(instr.label)
+
+            ops.append(op)
+            drs.append(dr)
+            sr1s.append(sr1)
+            sr2s.append(sr2)
+            imms.append(imm)
+
+        self.ops = _column('B', ops)
+        self.dr = _column('l', drs)
+        self.sr1 = _column('l', sr1s)
+        self.sr2 = _column('l', sr2s)
+        self.imm = _column('B', imms)
+        self.fused = _column('B', self._fuse())
+
+    @classmethod
+    def fromColumns(cls, ops, dr, sr1, sr2, imm, fused, registerNames, labels,
+                    linkError=None):
+        # program of columns built elsewhere, see programfile
+        program = cls.__new__(cls)
+        program.ops, program.dr, program.sr1, program.sr2 = ops, dr, sr1, sr2
+        program.imm, program.fused = imm, fused
+        program.registerNames = list(registerNames)
+        program.registerSlots = dict((r, slot) for slot, r in
+                                     enumerate(program.registerNames))
+        program.labels = labels
+        program.linkError = linkError
+
+        return program
+
+    def _fuse(self):
+        # both instructions of a pair are adjacent, so no branch can land
+        # on the second one: labels are instructions
+        ops, drs, sr1s, sr2s, imms = (self.ops, self.dr, self.sr1, self.sr2,
+                                      self.imm)
+        fused = list(ops)
+
+        i = 0
+        while i + 1 < len(ops):
+            kind = None
+            if (ops[i + 1] == OP_ADD and drs[i + 1] == drs[i] and
+               sr1s[i + 1] == drs[i]):
+                if ops[i] == OP_AND and imms[i] and sr2s[i] == 0:
+                    if imms[i + 1]:
+                        kind = OP_LOADIMM
+                    elif sr2s[i + 1] != drs[i]:
+                        kind = OP_MOVE
+                elif ops[i] == OP_NOT and imms[i + 1] and sr2s[i + 1] == 1:
+                    kind = OP_NEG
+
+            if kind is not None:
+                fused[i] = kind
+                i += 2
+            else:
+                i += 1
+
+        return fused
+
+    def intern(self, r):
+        if r not in self.registerSlots:
+            self.registerSlots[r] = len(self.registerNames)
+            self.registerNames.append(r)
+
+        return self.registerSlots[r]
+
+    def checkLinked(self):
+        if self.linkError is not None:
+            raise self.linkError
+
+
+class RegisterFile(Mapping):
+    # name -> value view over the register slots of a State,
+    # uninitialised registers are absent
+    def __init__(self, state):
+        self._state = state
+
+    def __getitem__(self, r):
+        slot = self._state.program.registerSlots[r]
+        value = self._state.values[slot]
+
+        if value is None:
+            raise KeyError(r)
+
+        return value
+
+    def __iter__(self):
+        for r, value in zip(self._state.program.registerNames,
+                            self._state.values):
+            if value is not None:
+                yield r
+
+    def __len__(self):
+        return sum(1 for value in self._state.values if value is not None)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def fingerprintWeight(slot):
+    # weight of a register in State.fingerprint
+    return 1 + slot * 2654435761 % 1000003
+
+
+class State:
+    def __init__(self, instrs, maxInstructions=100000, program=None,
+                 detectLoops=False):
+        self.instrs = instrs
+        self.maxInstructions = maxInstructions
+        self.detectLoops = detectLoops
+
+        # program can be given when already built by CustomProg.finalize
+        self.program = program or Program(instrs)
+
+        # labels offsets
+        self.labels = self.program.labels
+
+        # registers, by slot of the program
+        self.values = [None] * len(self.program.registerNames)
+        self.registers = RegisterFile(self)
 
         self.lastRegister = None
 
+        # number of instructions executed by run, and the number of
+        # fused pairs among them
+        self.executed = 0
+        self.fusedHits = 0
+
+        # sum of the values of the registers by their weight, kept up to
+        # date by the writes when detecting loops, see _backEdge
+        self.fingerprint = 0
+        self._weights = [fingerprintWeight(slot)
+                         for slot in range(len(self.values))]
+
+        # states saved at back-edges, see _backEdge
+        self._savedKey = None
+        self._savedState = None
+        self._backEdges = 0
+        self._nextSave = 1
+
     def getLastRegister(self):
         if self.lastRegister is not None:
             return self.lastRegister
@@ -280,16 +618,22 @@ class State:
             raise NotInitialisedRegisterError()
 
     def setRegister(self, r, value):
-        self.registers[r] = value
+        slot = self.program.intern(r)
+        if slot == len(self.values):
+            self.values.append(None)
+            self._weights.append(fingerprintWeight(slot))
+
+        self.fingerprint += (value - (self.values[slot] or 0)) * self._weights[slot]
+        self.values[slot] = value
 
         self.lastRegister = value
 
     def getRegister(self, r):
-        if r not in self.registers:
+        try:
+            return self.registers[r]
+        except KeyError:
             raise NotInitialisedRegisterError(r)
 
-        return self.registers[r]
-
     def getRegisterOrInt(self, roi):
         if isinstance(roi, int):
             return roi
@@ -297,21 +641,159 @@ class State:
             return self.getRegister(roi)
 
     def run(self):
-        count = 0
-        pc = 0
-        while pc < len(self.instrs):
-            instr = self.instrs[pc]
-            overridePc = instr.visit(self)
-
-            if overridePc is not None:
-                pc = overridePc
-            else:
-                pc += 1
-
-            count += 1
+        self.program.checkLinked()
+
+        self._interpret(0, 0)
+
+    def _interpret(self, pc, count, stop=-1):
+        # executes from pc until the end of the program, or until
+        # count reaches stop. Returns the pc of the next instruction
+        program = self.program
+        ops = program.ops
+        fused = program.fused
+        drs, sr1s, sr2s, imms = program.dr, program.sr1, program.sr2, program.imm
+        names = program.registerNames
+        R = self.values
+        last = self.lastRegister
+        maxInstructions = self.maxInstructions
+        detectLoops = self.detectLoops
+        fusedHits = self.fusedHits
+        fingerprint = self.fingerprint
+        weights = self._weights
 
-            if count > self.maxInstructions:
-                raise InfiniteLoopError()
+        try:
+            while pc < len(ops):
+                i = pc
+                pc += 1
+                op = fused[i]
+
+                if op > OP_BR:
+                    if count == maxInstructions or count + 1 == stop:
+                        # stop between the two instructions
+                        op = ops[i]
+                    elif op == OP_LOADIMM:
+                        v = sr2s[i + 1]
+                        d = drs[i]
+                        if detectLoops:
+                            fingerprint += (v - (R[d] or 0)) * weights[d]
+                        last = R[d] = v
+                    elif op == OP_NEG:
+                        v0 = R[sr1s[i]]
+                        if v0 is None:
+                            raise NotInitialisedRegisterError(names[sr1s[i]])
+
+                        v = -v0
+                        d = drs[i]
+                        if detectLoops:
+                            fingerprint += (v - (R[d] or 0)) * weights[d]
+                        last = R[d] = v
+                    else:
+                        v = R[sr2s[i + 1]]
+                        if v is None:
+                            # the And is executed before the error
+                            op = ops[i]
+                        else:
+                            d = drs[i]
+                            if detectLoops:
+                                fingerprint += (v - (R[d] or 0)) * weights[d]
+                            last = R[d] = v
+
+                    if op > OP_BR:
+                        pc += 1
+                        count += 1
+                        fusedHits += 1
+
+                if op == OP_ADD:
+                    v0 = R[sr1s[i]]
+                    if v0 is None:
+                        raise NotInitialisedRegisterError(names[sr1s[i]])
+
+                    if imms[i]:
+                        v1 = sr2s[i]
+                    else:
+                        v1 = R[sr2s[i]]
+                        if v1 is None:
+                            raise NotInitialisedRegisterError(names[sr2s[i]])
+
+                    v = v0 + v1
+                    d = drs[i]
+                    if detectLoops:
+                        fingerprint += (v - (R[d] or 0)) * weights[d]
+                    last = R[d] = v
+                elif op == OP_AND:
+                    v0 = R[sr1s[i]]
+                    v1 = sr2s[i] if imms[i] else R[sr2s[i]]
+
+                    if v0 is None or v1 is None:
+                        if v1 == 0:
+                            v = 0
+                        else:
+                            raise NotInitialisedRegisterError()
+                    else:
+                        v = v0 & v1
+
+                    d = drs[i]
+                    if detectLoops:
+                        fingerprint += (v - (R[d] or 0)) * weights[d]
+                    last = R[d] = v
+                elif op == OP_NOT:
+                    v0 = R[sr1s[i]]
+                    if v0 is None:
+                        raise NotInitialisedRegisterError(names[sr1s[i]])
+
+                    v = ~v0
+                    d = drs[i]
+                    if detectLoops:
+                        fingerprint += (v - (R[d] or 0)) * weights[d]
+                    last = R[d] = v
+                elif op == OP_BR:
+                    mask = drs[i]
+
+                    # do not read the last register if
+                    # the branch is unconditional
+                    if mask != ALWAYS and last is None:
+                        raise NotInitialisedRegisterError()
+
+                    if (mask == ALWAYS or
+                       mask & (N if last < 0 else Z if last == 0 else P)):
+                        pc = sr1s[i]
+
+                        if detectLoops and pc <= i:
+                            self._backEdge(i, last, fingerprint)
+
+                count += 1
+
+                if count > maxInstructions:
+                    raise InfiniteLoopError()
+
+                if count == stop:
+                    break
+        finally:
+            self.lastRegister = last
+            self.executed = count
+            self.fusedHits = fusedHits
+            self.fingerprint = fingerprint
+
+        return pc
+
+    def _backEdge(self, pc, last, fingerprint):
+        # The machine is deterministic: when the state at a taken
+        # back-edge repeats, the program loops forever. States are
+        # compared with Brent's cycle detection, which only keeps one
+        # saved state and finds a repetition within two cycles. The
+        # registers are only copied when a state is saved, and compared
+        # when the fingerprints are the same.
+        key = (pc, last, fingerprint)
+
+        if key == self._savedKey and tuple(self.values) == self._savedState:
+            raise InfiniteLoopError()
+
+        self._backEdges += 1
+        if self._backEdges == self._nextSave:
+            self._savedKey = key
+            self._savedState = tuple(self.values)
+            self._nextSave *= 2
+            self._backEdges = 0
 
     def getPcAtLabel(self, label):
         try:
@@ -320,6 +802,7 @@ class State:
             raise MissingLabelError(label)
 
 if __name__ == '__main__':
+    import sys
     import unittest
 
     r0 = "temp_0"
@@ -388,6 +871,63 @@ if __name__ == '__main__':
                         Add(r1, r0, 1)],
                        {r0: -6, r1: -5})
 
+        def test_compact_program(self):
+            state = State([And(r0, r0, 0),
+                           Add(r1, r0, 5),
+                           Label("l"),
+                           Br("nz", "l")])
+
+            self.assertEqual(state.program.registerNames, [r0, r1])
+            self.assertEqual(list(state.program.sr2), [0, 5, 0, 0])
+            self.assertEqual(list(state.program.imm), [1, 1, 0, 0])
+            self.assertFalse(hasattr(state.instrs[0], '__dict__'))
+
+        def test_registers_mapping(self):
+            state = State([And(r0, r0, 0), Add(r0, r0, 5), Br("", "l"),
+                           And(r1, r1, 0), Label("l")])
+            state.run()
+
+            self.assertIn(r0, state.registers)
+            self.assertNotIn(r1, state.registers)
+            self.assertEqual(list(state.registers.values()), [5])
+            self.assertEqual(repr(state.registers), repr({r0: 5}))
+
+        def test_visit(self):
+            instrs = [Comment("start"),
+                      And(r0, r0, 0),
+                      Add(r0, r0, 3),
+                      Label("loop"),
+                      Not(r1, r0),
+                      And(r2, r1, r0),
+                      Add(r0, r0, -1),
+                      Br("p", "loop"),
+                      Br("", "end"),
+                      Add(r3, r3, 1),
+                      Label("end")]
+            expected = State(instrs)
+            expected.run()
+
+            # instructions one by one, as run did before Program
+            state = State(instrs)
+            pc = 0
+            while pc < len(instrs):
+                overridePc = instrs[pc].visit(state)
+                pc = overridePc if overridePc is not None else pc + 1
+
+            self.assertEqual(state.registers, expected.registers)
+            self.assertEqual(state.getLastRegister(),
+                             expected.getLastRegister())
+
+            # registers the program does not use
+            Add(r4, r0, 5).visit(state)
+            self.assertEqual(state.registers[r4], 5)
+            with self.assertRaises(NotInitialisedRegisterError):
+                Not(r5, rCrap).visit(state)
+
+        def test_repr(self):
+            self.assertEqual(repr(Add(r0, r1, 3)),
+                             "Add(dr='temp_0', sr1='temp_1', sr2orimm7=3)")
+
         def _testLastRegister(self, res, instrs):
             state = State(instrs)
             state.run()
@@ -458,6 +998,42 @@ if __name__ == '__main__':
                     else:
                         self.assertEqual(state.registers["r" + reg], 0)
 
+        def test_executed(self):
+            state = State([And(r0, r0, 0), Add(r0, r0, 3),
+                           Label("loop"),
+                           Add(r0, r0, -1),
+                           Br("p", "loop")])
+            state.run()
+
+            self.assertEqual(state.executed, 2 + 3 * 3)
+
+        def test_fusion(self):
+            instrs = [And(r0, r0, 0), Add(r0, r0, 5),
+                      Not(r1, r0), Add(r1, r1, 1),
+                      And(r2, r2, 0), Add(r2, r2, r1),
+                      Label("l"),
+                      And(r3, r3, 0), Add(r3, r3, r3)]
+            state = State(instrs)
+            state.run()
+
+            self.assertEqual(list(state.program.fused)[:6],
+                             [OP_LOADIMM, OP_ADD, OP_NEG, OP_ADD,
+                              OP_MOVE, OP_ADD])
+            self.assertEqual(state.registers, {r0: 5, r1: -5, r2: -5, r3: 0})
+            self.assertEqual((state.executed, state.fusedHits), (9, 3))
+
+            # the limit falls between the two instructions
+            state = State([Label("a"), Label("b"),
+                           And(r0, r0, 0), Add(r0, r0, 5)], 2)
+            with self.assertRaises(InfiniteLoopError):
+                state.run()
+            self.assertEqual(state.registers, {r0: 0})
+
+            state = State([And(r0, r0, 0), Add(r0, r0, r1)])
+            with self.assertRaises(NotInitialisedRegisterError):
+                state.run()
+            self.assertEqual(state.registers, {r0: 0})
+
         def test_infinite_loop(self):
             state = State([
                 Label("start"), Br("", "start")])
@@ -465,12 +1041,143 @@ if __name__ == '__main__':
             with self.assertRaises(InfiniteLoopError):
                 state.run()
 
+        def test_detect_loops(self):
+            # r1 only takes 3 values, the loop never ends
+            instrs = [And(r0, r0, 0), And(r1, r1, 0),
+                      Label("loop"),
+                      Add(r0, r0, 1),
+                      And(r0, r0, 3),
+                      Add(r1, r0, 0),
+                      Br("", "loop")]
+
+            state = State(instrs, maxInstructions=10 ** 9, detectLoops=True)
+            with self.assertRaises(InfiniteLoopError):
+                state.run()
+
+        def test_detect_loops_terminating(self):
+            state = State([And(r0, r0, 0), Add(r0, r0, 15),
+                           Label("loop"),
+                           Add(r0, r0, -1),
+                           Br("p", "loop")], detectLoops=True)
+            state.run()
+
+            self.assertEqual(state.registers, {r0: 0})
+
+        def test_fingerprint(self):
+            state = State([And(r0, r0, 0), Add(r0, r0, 7), Not(r1, r0),
+                           Add(r2, r0, 0), And(r2, r2, 0)], detectLoops=True)
+            state.setRegister(r2, 4)
+            state.run()
+            state.setRegister(r3, -2)
+
+            self.assertEqual(state.fingerprint,
+                             sum((v or 0) * fingerprintWeight(slot)
+                                 for slot, v in enumerate(state.values)))
+
         def test_missing_label(self):
             state = State([Br("", "missing")])
 
             with self.assertRaises(MissingLabelError):
                 state.run()
 
+        def test_missing_label_not_taken(self):
+            # reported before running anything
+            state = State([And(r0, r0, 0), Br("n", "missing")])
+
+            with self.assertRaises(MissingLabelError):
+                state.run()
+
+            self.assertEqual(state.registers, {})
+
+        def test_duplicate_label(self):
+            state = State([Label("l"), And(r0, r0, 0), Label("l")])
+
+            with self.assertRaises(DuplicateLabelError):
+                state.run()
+
+        def test_linked_branches(self):
+            state = State([And(r0, r0, 0), Br("nz", "l"), Br("", "l"),
+                           Label("l")])
+
+            self.assertEqual(list(state.program.sr1), [0, 3, 3, 0])
+            self.assertEqual(list(state.program.dr), [0, N | Z, ALWAYS, 0])
+
+        def test_instruction_budget(self):
+            prog = CustomProg()
+            prog.budget = 3
+            for i in range(3):
+                prog._addInstr(Not(r0, r0))
+
+            with self.assertRaises(InstructionBudgetError):
+                prog._addInstr(Not(r0, r0))
+
+        def test_normalize_register(self):
+            for r in ["temp_1", " temp_1 ", "#5", "5", "-3", 4, "#x", u"temp_2"]:
+                self.assertEqual(normalizeRegister(r), _normalizeRegister(r))
+                # twice, from _normalized
+                self.assertEqual(normalizeRegister(r), _normalizeRegister(r))
+
+            self.assertEqual(normalizeRegister(True), "True")
+
+        @unittest.skipIf(sys.version_info[0] > 2, "CustomProg uses unicode")
+        def test_deferred_validation(self):
+            for emit, error in [(lambda p: p.addInstructionADD(r0, r1, 16),
+                                 OverflowConstantError),
+                                (lambda p: p.addInstructionAND(r0, 3, r1),
+                                 InvalidRegisterNameError),
+                                (lambda p: p.addInstructionNOT(r0, "#2"),
+                                 InvalidRegisterNameError),
+                                (lambda p: p.addInstructionBR("zz", "l"),
+                                 None),
+                                (lambda p: p.addInstructionBR("x", "l"),
+                                 UnexpectedBranchingLabelError),
+                                (lambda p: p.addLabel(3),
+                                 NotStringLabelError)]:
+                prog = CustomProg()
+                if error is not None:
+                    with self.assertRaises(error):
+                        emit(prog)
+
+                def deferred():
+                    prog = CustomProg()
+                    prog.deferValidation = True
+                    prog.addInstructionADD(r0, r1, "-15")
+                    emit(prog)
+                    prog.addLabel("l")
+                    prog.finalize()
+
+                if error is not None:
+                    with self.assertRaises(error):
+                        deferred()
+                else:
+                    deferred()
+
+        @unittest.skipIf(sys.version_info[0] > 2, "CustomProg uses unicode")
+        def test_deferred_validation_order(self):
+            # the first invalid instruction is reported, as when added
+            def emit(prog):
+                prog.addInstructionADD(r0, r1, 2)
+                prog.addInstructionNOT(r0, 4)
+                prog.addInstructionADD(r0, r1, 99)
+                prog.addInstructionBR("x", "l")
+
+            for deferValidation in [False, True]:
+                prog = CustomProg()
+                prog.deferValidation = deferValidation
+                with self.assertRaises(InvalidRegisterNameError) as cm:
+                    emit(prog)
+                    prog.finalize()
+                self.assertEqual(str(cm.exception), '4')
+
+            # the instruction over the budget is checked too
+            for deferValidation in [False, True]:
+                prog = CustomProg()
+                prog.budget = 1
+                prog.deferValidation = deferValidation
+                prog.addInstructionADD(r0, r1, 2)
+                with self.assertRaises(OverflowConstantError):
+                    prog.addInstructionAND(r0, r1, 16)
+
         def test_notinitialised_register_not(self):
             state = State([Not(r0, r0)])
 
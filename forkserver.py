@@ -0,0 +1,189 @@
+from __future__ import print_function
+
+import os
+import sys
+import json
+import errno
+import random
+import signal
+import socket
+import tempfile
+import importlib
+
+# imported once by the server and shared copy-on-write with every student
+# process; the student modules (MuLexer, MuParser, MyMuCodeGenVisitor)
+# and test_utils, which imports them, are only imported by the children
+preloaded = ['unittest', 'csv', 'collections',
+             'antlr4', 'antlr4.atn.PredictionMode',
+             'antlr4.error.ErrorStrategy', 'antlr4.error.Errors',
+             'customprog', 'analysis', 'blockcompiler', 'compilecache']
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def addStudentPath(path):
+    # after the harness, as PYTHONPATH is after the directory of the
+    # script: a student test.py or customprog.py cannot replace ours
+    try:
+        position = sys.path.index(here) + 1
+    except ValueError:
+        sys.path.insert(0, here)
+        position = 1
+
+    sys.path.insert(position, path)
+
+
+def preload():
+    for name in preloaded:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            # the children will import it again, and report the error
+            print('forkserver: cannot preload %s: %s' % (name, e),
+                  file=sys.stderr)
+
+
+def _send(conn, message):
+    conn.sendall((json.dumps(message) + '\n').encode('utf8'))
+
+
+def _readLine(conn):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+
+    return data
+
+
+def _read(f):
+    f.seek(0)
+    return f.read().decode('utf8', 'replace')
+
+
+def grade(conn, request):
+    # runs in the forked child: imports the modules of one student and
+    # runs the whole suite, then sends its record and its output
+    os.setsid()
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    # the parent random state is shared by every child
+    random.seed()
+
+    _send(conn, {'pid': os.getpid()})
+
+    os.environ.update(request.get('env', {}))
+    addStudentPath(request['path'])
+
+    # the student output goes to temporary files, sent at the end
+    out = tempfile.TemporaryFile()
+    err = tempfile.TemporaryFile()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(out.fileno(), 1)
+    os.dup2(err.fileno(), 2)
+
+    record = None
+    try:
+        import unittest
+        import test
+
+        suite = unittest.defaultTestLoader.loadTestsFromTestCase(test.TestCase)
+        result = unittest.TextTestRunner(stream=sys.stderr,
+                                         resultclass=test.GradingResult).run(suite)
+
+        header, row = test.resultRows(test.errorTests(result), test.timings)
+        record = {'header': header, 'row': row}
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    _send(conn, {'record': record, 'stdout': _read(out), 'stderr': _read(err)})
+
+
+def serve(path):
+    # One connection per student: the client sends a json line with the
+    # path of the student files and extra environment variables, gets
+    # back {"pid": ...} as soon as the child is forked, so that it can
+    # kill its process group, then {"record", "stdout", "stderr"}.
+    preload()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    server.bind(path)
+    server.listen(64)
+
+    # children are reaped by the kernel
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    print('ready')
+    sys.stdout.flush()
+
+    while True:
+        try:
+            conn, _ = server.accept()
+        except socket.error as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+
+        if os.fork() == 0:
+            server.close()
+            try:
+                grade(conn, json.loads(_readLine(conn).decode('utf8')))
+            finally:
+                os._exit(0)
+
+        conn.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        serve(sys.argv[1])
+        sys.exit()
+
+    import shutil
+    import unittest
+
+    def find(name):
+        try:
+            from importlib.util import find_spec
+        except ImportError:
+            import imp
+            f, path, _ = imp.find_module(name)
+            if f is not None:
+                f.close()
+            return path
+
+        return find_spec(name).origin
+
+    class Test(unittest.TestCase):
+        def test_student_path(self):
+            directory = tempfile.mkdtemp()
+            path = list(sys.path)
+            try:
+                for name in ['test_utils.py', 'customprog.py', 'MuLexer.py']:
+                    open(os.path.join(directory, name), 'w').close()
+
+                addStudentPath(directory)
+
+                self.assertEqual(find('test_utils'),
+                                 os.path.join(here, 'test_utils.py'))
+                self.assertEqual(find('customprog'),
+                                 os.path.join(here, 'customprog.py'))
+                self.assertEqual(find('MuLexer'),
+                                 os.path.join(directory, 'MuLexer.py'))
+            finally:
+                sys.path[:] = path
+                shutil.rmtree(directory)
+
+    unittest.main()
@@ -0,0 +1,98 @@
+from __future__ import print_function
+
+import signal
+import resource
+
+
+# not an Exception, so that an except Exception of the student code
+# cannot stop it, as KeyboardInterrupt
+class CPUTimeLimitError(BaseException):
+    pass
+
+
+def _expired(signum, frame):
+    raise CPUTimeLimitError()
+
+
+class Governor:
+    # Resource budgets of one test program, shared by the generation of
+    # its code and its run, each entered with a with statement:
+    # - cpuTime: CPU seconds, raises CPUTimeLimitError
+    # - memory: bytes of address space of the process, allocations
+    #   over it raise MemoryError
+    # - instructions: instructions the student visitor may emit, see
+    #   CustomProg.budget
+    # None means no limit.
+    def __init__(self, cpuTime=None, memory=None, instructions=None):
+        self.cpuTime = cpuTime
+        self.memory = memory
+        self.instructions = instructions
+
+    def __enter__(self):
+        if self.cpuTime is not None:
+            if self.cpuTime <= 0:
+                raise CPUTimeLimitError()
+
+            self._handler = signal.signal(signal.SIGPROF, _expired)
+            signal.setitimer(signal.ITIMER_PROF, self.cpuTime)
+
+        if self.memory is not None:
+            self._rlimit = resource.getrlimit(resource.RLIMIT_AS)
+            hard = self._rlimit[1]
+            if hard == resource.RLIM_INFINITY:
+                soft = self.memory
+            else:
+                soft = min(self.memory, hard)
+            resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+        return self
+
+    def __exit__(self, *exc):
+        if self.cpuTime is not None:
+            # the next with statement gets what remains
+            remaining = signal.setitimer(signal.ITIMER_PROF, 0)[0]
+            signal.signal(signal.SIGPROF, self._handler)
+
+            # the timer is rounded to its resolution
+            self.cpuTime = max(0, min(remaining, self.cpuTime))
+
+        if self.memory is not None:
+            resource.setrlimit(resource.RLIMIT_AS, self._rlimit)
+
+        return False
+
+if __name__ == '__main__':
+    import unittest
+
+    class Test(unittest.TestCase):
+        def test_cpu_time(self):
+            governor = Governor(cpuTime=0.05)
+
+            with self.assertRaises(CPUTimeLimitError):
+                with governor:
+                    while True:
+                        pass
+
+            # the budget is spent for the next phases too
+            with self.assertRaises(CPUTimeLimitError):
+                with governor:
+                    pass
+
+        def test_cpu_time_shared(self):
+            governor = Governor(cpuTime=10)
+            with governor:
+                sum(range(100000))
+
+            self.assertTrue(0 < governor.cpuTime <= 10)
+            self.assertEqual(signal.getitimer(signal.ITIMER_PROF), (0.0, 0.0))
+
+        def test_memory(self):
+            before = resource.getrlimit(resource.RLIMIT_AS)
+
+            with self.assertRaises(MemoryError):
+                with Governor(memory=1024 ** 3):
+                    ' ' * (2 * 1024 ** 3)
+
+            self.assertEqual(resource.getrlimit(resource.RLIMIT_AS), before)
+
+    unittest.main()
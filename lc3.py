@@ -0,0 +1,721 @@
+from __future__ import print_function
+
+from array import array
+
+from customprog import (State, InfiniteLoopError, NotInitialisedRegisterError,
+                        OP_NOP, OP_LABEL, OP_AND, OP_ADD, OP_NOT, OP_BR,
+                        N, Z, P, ALWAYS)
+
+# Programs assembled into 16-bit LC-3 words, and run by a machine over
+# its 64K words of memory:
+# - the registers of the program live in maxSlots memory words around
+#   base, which R6 points to, reached with LDR and STR
+# - And, Add and Not load their operands in R0 and R1, compute in R0 and
+#   store it: LDR, [LDR], op, STR
+# - Br is a BR, Labels and Comments are NOPs (BR never taken)
+# so each instruction of the program ends with a STR or a BR, which the
+# machine counts as State counts instructions.
+origin = 0x3000
+base = 0x2FE0
+maxSlots = 64
+
+OPC_BR, OPC_ADD, OPC_AND, OPC_NOT, OPC_LDR, OPC_STR = 0, 1, 5, 9, 6, 7
+R0, R1, R6 = 0, 1, 6
+
+
+class EncodingError(Exception):
+    pass
+
+
+class IllegalInstructionError(Exception):
+    pass
+
+
+def signed(word):
+    return word - 0x10000 if word & 0x8000 else word
+
+
+def _ldr(r, offset):
+    return (OPC_LDR << 12) | (r << 9) | (R6 << 6) | (offset & 0x3F)
+
+
+def _str(r, offset):
+    return (OPC_STR << 12) | (r << 9) | (R6 << 6) | (offset & 0x3F)
+
+
+def _branch(nzp, offset):
+    if not -256 <= offset <= 255:
+        raise EncodingError('branch over 9 bits')
+
+    return (nzp << 9) | (offset & 0x1FF)
+
+
+class Encoded:
+    # words of a program from origin, and the register of each slot,
+    # slot k being at address base - maxSlots // 2 + k
+    def __init__(self, words, names):
+        self.words = words
+        self.names = names
+
+
+def encode(program):
+    # Encoded of a linked customprog.Program. Raises EncodingError when
+    # the program has more than maxSlots registers, immediates over 5
+    # bits or branches over 9 bits.
+    names = program.registerNames
+    if len(names) > maxSlots:
+        raise EncodingError('%d registers' % len(names))
+
+    ops, drs, sr1s, sr2s, imms = (program.ops, program.dr, program.sr1,
+                                  program.sr2, program.imm)
+
+    def offset(slot):
+        return slot - maxSlots // 2
+
+    # address of each instruction
+    addresses = []
+    address = origin
+    for pc in range(len(ops)):
+        addresses.append(address)
+        op = ops[pc]
+        if op == OP_NOT or (op in (OP_AND, OP_ADD) and imms[pc]):
+            address += 3
+        elif op in (OP_AND, OP_ADD):
+            address += 4
+        else:
+            address += 1
+    addresses.append(address)
+
+    words = []
+    for pc in range(len(ops)):
+        op = ops[pc]
+        if op in (OP_NOP, OP_LABEL):
+            words.append(0)
+        elif op == OP_BR:
+            nzp = drs[pc]
+            words.append(_branch(nzp, addresses[sr1s[pc]] - addresses[pc] - 1))
+        elif op == OP_NOT:
+            words += [_ldr(R0, offset(sr1s[pc])),
+                      (OPC_NOT << 12) | (R0 << 9) | (R0 << 6) | 0x3F,
+                      _str(R0, offset(drs[pc]))]
+        else:
+            opcode = OPC_AND if op == OP_AND else OPC_ADD
+            words.append(_ldr(R0, offset(sr1s[pc])))
+            if imms[pc]:
+                if not -16 <= sr2s[pc] <= 15:
+                    raise EncodingError('immediate %d over 5 bits' % sr2s[pc])
+                words.append((opcode << 12) | (R0 << 9) | (R0 << 6) | 0x20 |
+                             (sr2s[pc] & 0x1F))
+            else:
+                words += [_ldr(R1, offset(sr2s[pc])),
+                          (opcode << 12) | (R0 << 9) | (R0 << 6) | R1]
+            words.append(_str(R0, offset(drs[pc])))
+
+    if addresses[-1] > 0xFE00:
+        raise EncodingError('program over the user memory')
+
+    return Encoded(words, names)
+
+
+# executions of a block before it is translated to python, see
+# Machine.run: most blocks of the graded programs run once, and are
+# cheaper to interpret than to compile
+hotBlock = 8
+
+
+class Machine:
+    # LC-3 subset of the encoder, with 16-bit words and NZP condition
+    # codes. initialised has a byte per word of memory, and inits one per
+    # register: what State reports as NotInitialisedRegisterError.
+    def __init__(self, encoded):
+        self.encoded = encoded
+        self.memory = array('H', [0]) * 0x10000
+        self.initialised = bytearray(0x10000)
+
+        self.end = origin + len(encoded.words)
+        self.memory[origin:self.end] = array('H', encoded.words)
+
+        self.registers = [0] * 8
+        self.inits = [False] * 8
+        self.registers[R6] = base
+        self.inits[R6] = True
+        # address each register was loaded from, for the errors
+        self.loaded = [None] * 8
+
+        self.cc = 0
+        self.last = None
+        self.executed = 0
+        self.maxInstructions = 100000
+        self.detectLoops = False
+
+        # states saved at back-edges, see State._backEdge
+        self._savedKey = None
+        self._savedState = None
+        self._backEdges = 0
+        self._nextSave = 1
+
+        self._splitBlocks()
+
+    def _name(self, r):
+        return self.encoded.names[self.loaded[r] - base + maxSlots // 2]
+
+    def _splitBlocks(self):
+        # Basic blocks of the words, by offset from origin: a block
+        # starts at origin, at each BR target and after each BR which
+        # may be taken, and ends with its last counted word (STR or BR).
+        # sizes[k] and lengths[k] are the words and counted words of the
+        # block at origin + k, None elsewhere. Blocks are only translated
+        # when every LDR and STR is relative to R6, which nothing
+        # writes, and no STR writes the program.
+        words = self.memory[origin:self.end]
+        n = len(words)
+        leaders = set([0, n])
+        self.translatable = True
+
+        for k, w in enumerate(words):
+            opcode = w >> 12
+            if opcode == OPC_BR:
+                if (w >> 9) & 7:
+                    offset = w & 0x1FF
+                    if offset & 0x100:
+                        offset -= 0x200
+                    leaders.add(k + 1)
+                    if 0 <= k + 1 + offset <= n:
+                        leaders.add(k + 1 + offset)
+                    else:
+                        self.translatable = False
+            elif opcode in (OPC_LDR, OPC_STR):
+                if (w >> 6) & 7 != R6:
+                    self.translatable = False
+                if opcode == OPC_LDR and (w >> 9) & 7 == R6:
+                    self.translatable = False
+                if opcode == OPC_STR:
+                    offset = w & 0x3F
+                    if offset & 0x20:
+                        offset -= 0x40
+                    if origin <= base + offset < self.end:
+                        self.translatable = False
+            elif opcode in (OPC_ADD, OPC_AND, OPC_NOT):
+                if (w >> 9) & 7 == R6:
+                    self.translatable = False
+            else:
+                self.translatable = False
+
+        self.sizes = [None] * n
+        self.lengths = [None] * n
+        leaders = sorted(leaders)
+        for k, next in zip(leaders, leaders[1:]):
+            last = words[next - 1] >> 12
+            if last != OPC_STR and last != OPC_BR:
+                self.translatable = False
+            self.sizes[k] = next - k
+            self.lengths[k] = sum(1 for w in words[k:next]
+                                  if w >> 12 in (OPC_STR, OPC_BR))
+
+        self.blocks = [None] * n
+        self.hits = [0] * n
+
+    def run(self, maxInstructions=100000, detectLoops=False):
+        # Runs the blocks translated to python, and interprets the others
+        # with _interpret. A translated block first checks that it reads
+        # no uninitialised word nor register, and that the condition codes
+        # are set when it branches on them; otherwise it returns None and
+        # is interpreted, which raises the same errors at the same word.
+        self.maxInstructions = maxInstructions
+        self.detectLoops = detectLoops
+
+        if not self.translatable:
+            self._interpret(origin, self.executed)
+            return
+
+        blocks = self.blocks
+        hits = self.hits
+        sizes = self.sizes
+        lengths = self.lengths
+        end = self.end
+        count = self.executed
+
+        pc = origin
+        while pc < end:
+            k = pc - origin
+            length = lengths[k]
+
+            if count + length > maxInstructions:
+                # the limit falls in this block
+                self._interpret(pc, count)
+                return
+
+            block = blocks[k]
+            if block is None:
+                hits[k] += 1
+                if hits[k] == hotBlock:
+                    block = blocks[k] = self._translate(k)
+
+            newPc = None if block is None else block(self)
+            if newPc is None:
+                pc = self._interpret(pc, count, count + length)
+                count = self.executed
+                continue
+
+            if detectLoops and newPc < pc + sizes[k]:
+                # a taken backward BR ends the block
+                self.executed = count + length - 1
+                self._backEdge(pc + sizes[k], self.last, self.cc)
+
+            pc = newPc
+            count += length
+
+        self.executed = count
+
+    def _translate(self, k):
+        # python function of the block at origin + k, which runs it on
+        # the machine and returns the address of the next word, or None
+        # when the block must be interpreted, see run. Registers and
+        # words are kept in variables, and written back at the end.
+        start = origin + k
+        words = self.memory[start:start + self.sizes[k]]
+
+        loads = []
+        body = []
+        checks = []
+        # register -> (variable, address of the word it was loaded from
+        # or None when it was computed), those read at the start of the
+        # block have the source ('R', r)
+        regs = {}
+        stored = {}
+        last = None
+        cc = None
+        branch = None
+
+        def newvar():
+            return 'v%d' % (len(loads) + len(body))
+
+        def check(condition):
+            if condition not in checks:
+                checks.append(condition)
+
+        def read(r):
+            # variable of register r, which must be initialised
+            if r not in regs:
+                var = newvar()
+                loads.append('%s = R[%d]' % (var, r))
+                regs[r] = (var, ('R', r))
+
+            var, source = regs[r]
+            if source == ('R', r):
+                check('RI[%d]' % r)
+            elif source is not None:
+                check('I[%d]' % source)
+
+            return var
+
+        def address(w):
+            offset = w & 0x3F
+            if offset & 0x20:
+                offset -= 0x40
+            return (base + offset) & 0xFFFF
+
+        def write(r, expr):
+            var = newvar()
+            body.append('%s = %s' % (var, expr))
+            regs[r] = (var, None)
+            return var
+
+        for idx, w in enumerate(words):
+            opcode = w >> 12
+            r = (w >> 9) & 7
+            r1 = (w >> 6) & 7
+
+            if opcode == OPC_LDR:
+                a = address(w)
+                if a in stored:
+                    regs[r] = (stored[a], None)
+                else:
+                    var = newvar()
+                    body.append('%s = M[%d]' % (var, a))
+                    regs[r] = (var, a)
+                cc = regs[r][0]
+            elif opcode == OPC_STR:
+                stored[address(w)] = last = read(r)
+            elif opcode == OPC_ADD:
+                if w & 0x20:
+                    operand = '%d' % ((w & 0x1F) | (0xFFE0 if w & 0x10 else 0))
+                else:
+                    operand = read(w & 7)
+                cc = write(r, '(%s + %s) & 0xFFFF' % (read(r1), operand))
+            elif opcode == OPC_AND:
+                if w & 0x20:
+                    imm = (w & 0x1F) | (0xFFE0 if w & 0x10 else 0)
+                    if imm == 0:
+                        # And does not need r1 in that case
+                        cc = write(r, '0')
+                    else:
+                        cc = write(r, '%s & %d' % (read(r1), imm))
+                else:
+                    cc = write(r, '%s & %s' % (read(r1), read(w & 7)))
+            elif opcode == OPC_NOT:
+                cc = write(r, '%s ^ 0xFFFF' % read(r1))
+            elif r:
+                # BR, the last word of its block
+                offset = w & 0x1FF
+                if offset & 0x100:
+                    offset -= 0x200
+                branch = (r, start + idx + 1 + offset)
+
+        lines = ['def block(machine, M=machine.memory, I=machine.initialised,',
+                 '          R=machine.registers, RI=machine.inits,',
+                 '          L=machine.loaded):']
+
+        if branch is not None and branch[0] != ALWAYS and last is None:
+            # unconditional branches do not read the codes
+            check('machine.last is not None')
+        if checks:
+            lines.append('if not (%s):' % ' and '.join(checks))
+            lines.append('    return None')
+
+        lines.extend(loads)
+        lines.extend(body)
+
+        # the flags of the registers are read before the words are written
+        for r, (var, source) in sorted(regs.items()):
+            if source == ('R', r):
+                continue
+            lines.append('R[%d] = %s' % (r, var))
+            if source is None:
+                lines.append('RI[%d] = True' % r)
+            else:
+                lines.append('RI[%d] = bool(I[%d])' % (r, source))
+                lines.append('L[%d] = %d' % (r, source))
+
+        for a, var in sorted(stored.items()):
+            lines.append('M[%d] = %s' % (a, var))
+            if 'I[%d]' % a not in checks:
+                lines.append('I[%d] = 1' % a)
+
+        if last is not None:
+            lines.append('machine.last = %s' % last)
+        if cc is not None:
+            lines.append('cc = %d if %s & 0x8000 else %d if %s == 0 else %d'
+                         % (N, cc, Z, cc, P))
+            lines.append('machine.cc = cc')
+
+        if branch is not None:
+            nzp, target = branch
+            if nzp == ALWAYS:
+                lines.append('return %d' % target)
+            else:
+                if cc is None:
+                    lines.append('cc = machine.cc')
+                lines.append('if cc & %d:' % nzp)
+                lines.append('    return %d' % target)
+        lines.append('return %d' % (start + len(words)))
+
+        namespace = {'machine': self}
+        exec(compile('\n    '.join(lines), '<lc3 block %04x>' % start,
+                     'exec'), namespace)
+
+        return namespace['block']
+
+    def _interpret(self, pc, count, stop=-1):
+        # runs the words from pc until the end of the program, or until
+        # count reaches stop. Returns the address of the next word
+        mem = self.memory
+        initialised = self.initialised
+        R = self.registers
+        inits = self.inits
+        loaded = self.loaded
+        end = self.end
+        cc = self.cc
+        last = self.last
+        maxInstructions = self.maxInstructions
+        detectLoops = self.detectLoops
+
+        try:
+            while pc < end:
+                w = mem[pc]
+                pc += 1
+                opcode = w >> 12
+
+                if opcode == OPC_LDR:
+                    r = (w >> 9) & 7
+                    offset = w & 0x3F
+                    if offset & 0x20:
+                        offset -= 0x40
+                    address = (R[(w >> 6) & 7] + offset) & 0xFFFF
+                    v = R[r] = mem[address]
+                    inits[r] = initialised[address]
+                    loaded[r] = address
+                    cc = N if v & 0x8000 else Z if v == 0 else P
+                    continue
+                elif opcode == OPC_STR:
+                    r = (w >> 9) & 7
+                    offset = w & 0x3F
+                    if offset & 0x20:
+                        offset -= 0x40
+                    address = (R[(w >> 6) & 7] + offset) & 0xFFFF
+                    mem[address] = R[r]
+                    initialised[address] = 1
+                    last = R[r]
+                elif opcode == OPC_ADD or opcode == OPC_AND:
+                    r = (w >> 9) & 7
+                    r1 = (w >> 6) & 7
+                    if w & 0x20:
+                        v1 = w & 0x1F
+                        init1 = True
+                    else:
+                        v1 = R[w & 7]
+                        init1 = inits[w & 7]
+
+                    if opcode == OPC_ADD:
+                        if not inits[r1]:
+                            raise NotInitialisedRegisterError(self._name(r1))
+                        if not init1:
+                            raise NotInitialisedRegisterError(self._name(w & 7))
+                        # 5-bit immediates are sign extended to 16 bits
+                        if w & 0x20 and v1 & 0x10:
+                            v1 |= 0xFFE0
+                        v = R[r] = (R[r1] + v1) & 0xFFFF
+                    else:
+                        if w & 0x20 and v1 & 0x10:
+                            v1 |= 0xFFE0
+                        if not (inits[r1] and init1):
+                            if not (init1 and v1 == 0):
+                                raise NotInitialisedRegisterError()
+                            v = R[r] = 0
+                        else:
+                            v = R[r] = R[r1] & v1
+
+                    inits[r] = True
+                    cc = N if v & 0x8000 else Z if v == 0 else P
+                    continue
+                elif opcode == OPC_NOT:
+                    r = (w >> 9) & 7
+                    r1 = (w >> 6) & 7
+                    if not inits[r1]:
+                        raise NotInitialisedRegisterError(self._name(r1))
+                    v = R[r] = R[r1] ^ 0xFFFF
+                    inits[r] = True
+                    cc = N if v & 0x8000 else Z if v == 0 else P
+                    continue
+                elif opcode == OPC_BR:
+                    nzp = (w >> 9) & 7
+                    if nzp:
+                        # unconditional branches do not read the codes
+                        if nzp != ALWAYS and last is None:
+                            raise NotInitialisedRegisterError()
+                        if nzp == ALWAYS or nzp & cc:
+                            offset = w & 0x1FF
+                            if offset & 0x100:
+                                offset -= 0x200
+                                if detectLoops:
+                                    self._backEdge(pc, last, cc)
+                            pc += offset
+                else:
+                    raise IllegalInstructionError('%04x at %04x' % (w, pc - 1))
+
+                count += 1
+                if count > maxInstructions:
+                    raise InfiniteLoopError()
+
+                if count == stop:
+                    break
+        finally:
+            self.cc = cc
+            self.last = last
+            self.executed = count
+
+        return pc
+
+    def _backEdge(self, pc, last, cc):
+        # Brent's cycle detection as State does, on the words and the
+        # initialised flags of the registers: a back-edge of the program
+        # is a taken BR of negative offset. The registers are only copied
+        # when a state is saved, or when the rest of the state matches.
+        start = base - maxSlots // 2
+        stop = start + len(self.encoded.names)
+        key = (pc, last, cc)
+
+        if (key == self._savedKey and
+                (self.memory[start:stop],
+                 self.initialised[start:stop]) == self._savedState):
+            raise InfiniteLoopError()
+
+        self._backEdges += 1
+        if self._backEdges == self._nextSave:
+            self._savedKey = key
+            self._savedState = (self.memory[start:stop],
+                                self.initialised[start:stop])
+            self._nextSave *= 2
+            self._backEdges = 0
+
+    def slots(self):
+        # (register, value) of the initialised registers
+        start = base - maxSlots // 2
+        for k, name in enumerate(self.encoded.names):
+            if self.initialised[start + k]:
+                yield k, name, signed(self.memory[start + k])
+
+
+class LC3State(State):
+    # State which runs the program on the LC-3 machine, with 16-bit
+    # registers, when it can be encoded
+    def run(self):
+        self.program.checkLinked()
+
+        try:
+            encoded = encode(self.program)
+        except EncodingError:
+            return State.run(self)
+
+        machine = Machine(encoded)
+        try:
+            machine.run(self.maxInstructions, self.detectLoops)
+        finally:
+            for slot, name, value in machine.slots():
+                self.values[slot] = value
+            self.lastRegister = (None if machine.last is None
+                                 else signed(machine.last))
+            self.executed = machine.executed
+
+if __name__ == '__main__':
+    import random
+    import unittest
+
+    from customprog import Program, And, Add, Not, Br, Label, Comment
+    from optimizer import outcome
+
+    r0 = "temp_0"
+    r1 = "temp_1"
+    r2 = "temp_2"
+
+    class Test(unittest.TestCase):
+        def _check(self, instrs, maxInstructions=100000, detectLoops=False):
+            original = State(instrs, maxInstructions, detectLoops=detectLoops)
+            expected = outcome(original)
+            state = LC3State(instrs, maxInstructions, detectLoops=detectLoops)
+            self.assertEqual(outcome(state), expected)
+            self.assertEqual(state.executed, original.executed)
+            return state
+
+        def test_encoding(self):
+            # LDR R0, R6, #-32; AND R0, R0, #0; STR R0, R6, #-32 ...
+            encoded = encode(Program([And(r0, r0, 0), Add(r0, r0, -3),
+                                      Label("l"), Not(r1, r0),
+                                      Add(r2, r0, r1), Br("np", "l")]))
+
+            self.assertEqual(['%04x' % w for w in encoded.words],
+                             ['61a0', '5020', '71a0',
+                              '61a0', '103d', '71a0',
+                              '0000',
+                              '61a0', '903f', '71a1',
+                              '61a0', '63a1', '1001', '71a2',
+                              '0bf7'])
+
+        def test_same_as_state(self):
+            state = self._check([Comment("c"), And(r0, r0, 0), Add(r0, r0, 5),
+                                 Label("loop"),
+                                 Not(r1, r0),
+                                 And(r2, r1, r0),
+                                 Add(r0, r0, -1),
+                                 Br("p", "loop"),
+                                 Br("", "end"),
+                                 Add(r0, r0, 15),
+                                 Label("end")])
+            self.assertEqual(state.executed, 3 + 5 * 5 + 2)
+
+        def test_errors(self):
+            self._check([Add(r0, r1, 1)])
+            self._check([And(r0, r0, 0), Add(r0, r0, r1)])
+            self._check([Not(r0, r1)])
+            self._check([And(r0, r1, 2)])
+            self._check([And(r0, r0, 0), And(r1, r2, r0)])
+            self._check([Br("z", "l"), Label("l")])
+            self._check([Br("", "l"), Label("l")])
+            self._check([Label("l"), Br("", "l")], 100)
+
+        def test_detect_loops(self):
+            # r0 only takes 4 values
+            state = self._check([And(r0, r0, 0),
+                                 Label("loop"),
+                                 Add(r0, r0, 1),
+                                 And(r0, r0, 3),
+                                 Not(r1, r0),
+                                 Br("", "loop")], 10 ** 9, True)
+            self.assertLess(state.executed, 100)
+
+            self._check([And(r0, r0, 0), Add(r0, r0, 15),
+                         Label("loop"),
+                         Add(r1, r0, 0),
+                         Add(r0, r0, -1),
+                         Br("p", "loop")], 10 ** 9, True)
+
+        def test_wraparound(self):
+            instrs = [And(r0, r0, 0), Add(r0, r0, -1), Not(r1, r0)]
+            for _ in range(16):
+                instrs.append(Add(r1, r1, r1))
+            state = LC3State(instrs)
+            state.run()
+
+            self.assertEqual(dict(state.registers), {r0: -1, r1: 0})
+
+        def test_fallback(self):
+            far = [And(r0, r0, 0), Br("z", "l")]
+            far += [Add(r0, r0, 1)] * 100 + [Label("l")]
+            with self.assertRaises(EncodingError):
+                encode(Program(far))
+            self._check(far)
+
+            many = [And("t%d" % k, "t%d" % k, 0) for k in range(maxSlots + 1)]
+            with self.assertRaises(EncodingError):
+                encode(Program(many))
+            self._check(many)
+
+        def test_translated(self):
+            loop = [And(r0, r0, 0), Add(r0, r0, 12),
+                    Label("loop"),
+                    Not(r1, r0),
+                    And(r2, r1, r0),
+                    Add(r0, r0, -1),
+                    Br("p", "loop")]
+            machine = Machine(encode(Program(loop)))
+            machine.run()
+            self.assertEqual(sum(1 for b in machine.blocks if b), 1)
+            self._check(loop)
+
+            # every block translated when first run
+            global hotBlock
+            saved = hotBlock
+            hotBlock = 1
+            try:
+                self.test_same_as_state()
+                self.test_errors()
+                self.test_detect_loops()
+                self.test_wraparound()
+                self.test_random()
+            finally:
+                hotBlock = saved
+
+        def test_random(self):
+            # small values, which State and the machine compute the same
+            rng = random.Random(0)
+            registers = [r0, r1, r2]
+            for _ in range(300):
+                instrs = []
+                for k in range(rng.randint(1, 12)):
+                    kind = rng.randint(0, 5)
+                    dr, sr1, sr2 = [rng.choice(registers) for _ in range(3)]
+                    if kind == 0:
+                        instrs.append(And(dr, sr1, rng.choice([0, 0, 3, sr2])))
+                    elif kind == 1:
+                        instrs.append(Add(dr, sr1, rng.choice([-2, 1, sr2])))
+                    elif kind == 2:
+                        instrs.append(Not(dr, sr1))
+                    elif kind == 3:
+                        instrs.append(Label("l%d" % k))
+                    else:
+                        instrs.append(Br(rng.choice(["", "n", "z", "p", "np"]),
+                                         "l%d" % rng.randint(0, 11)))
+                self._check(instrs, 200)
+                self._check(instrs, 200, True)
+
+    unittest.main()
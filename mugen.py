@@ -0,0 +1,334 @@
+from __future__ import print_function
+
+import sys
+import time
+import random
+import argparse
+
+# Mu programs as tuples:
+# - statements: ('assign', name, expr), ('if', [(cond, block)...], block
+#   or None) for if / else if / else, ('while', cond, block)
+# - expressions: ('int', n), ('var', name), ('neg', e), ('not', e),
+#   ('+', a, b), ('-', a, b)
+# - conditions: ('<', a, b) ... ('!=', a, b), ('&&', c, d), ('||', c, d)
+
+comparisons = {
+    '<': lambda a, b: a < b,
+    '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+}
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+class Generator:
+    # Random well-formed Mu programs: every variable is assigned before
+    # being read, and every while loop has its own counter, which only
+    # its last statement changes, so every program terminates.
+    def __init__(self, seed=0, variables=5, statements=20, depth=3,
+                 logic=True, maxConstant=15, maxIterations=5):
+        self.rng = random.Random(seed)
+        self.variables = ['v%d' % k for k in range(variables)]
+        self.statements = statements
+        self.depth = depth
+        self.logic = logic
+        self.maxConstant = maxConstant
+        self.maxIterations = maxIterations
+        self.counters = 0
+
+    def program(self):
+        self.counters = 0
+        init = [('assign', v, ('int', self.rng.randint(0, self.maxConstant)))
+                for v in self.variables]
+
+        return init + self.block(self.statements, self.depth, [])
+
+    def block(self, size, depth, counters):
+        return [self.statement(depth, counters) for _ in range(size)]
+
+    def statement(self, depth, counters):
+        kind = self.rng.random()
+        size = self.rng.randint(1, 4)
+
+        if depth > 0 and kind < 0.15:
+            counter = 'i%d' % self.counters
+            self.counters += 1
+
+            body = self.block(size, depth - 1, counters + [counter])
+            body.append(('assign', counter,
+                         ('+', ('var', counter), ('int', 1))))
+            limit = ('int', self.rng.randint(0, self.maxIterations))
+
+            return ('block', [('assign', counter, ('int', 0)),
+                              ('while', ('<', ('var', counter), limit),
+                               body)])
+        elif depth > 0 and kind < 0.35:
+            branches = [(self.condition(counters),
+                         self.block(size, depth - 1, counters))
+                        for _ in range(self.rng.randint(1, 3))]
+            orelse = None
+            if self.rng.random() < 0.5:
+                orelse = self.block(size, depth - 1, counters)
+
+            return ('if', branches, orelse)
+
+        return ('assign', self.rng.choice(self.variables),
+                self.expression(2, counters))
+
+    def atom(self, counters):
+        if self.rng.random() < 0.3:
+            return ('int', self.rng.randint(0, self.maxConstant))
+
+        return ('var', self.rng.choice(self.variables + counters))
+
+    def expression(self, depth, counters):
+        kind = self.rng.random()
+
+        if depth == 0 or kind < 0.3:
+            return self.atom(counters)
+        elif kind < 0.4:
+            return (self.rng.choice(['neg', 'not']), self.atom(counters))
+
+        return (self.rng.choice(['+', '-']),
+                self.expression(depth - 1, counters),
+                self.expression(depth - 1, counters))
+
+    def condition(self, counters, depth=1):
+        if self.logic and depth > 0 and self.rng.random() < 0.3:
+            return (self.rng.choice(['&&', '||']),
+                    self.condition(counters, depth - 1),
+                    self.condition(counters, depth - 1))
+
+        return (self.rng.choice(sorted(comparisons)),
+                self.expression(1, counters), self.expression(1, counters))
+
+
+def renderExpression(e):
+    kind = e[0]
+    if kind == 'int':
+        return str(e[1])
+    elif kind == 'var':
+        return e[1]
+    elif kind == 'neg':
+        return '-' + renderExpression(e[1])
+    elif kind == 'not':
+        return '!' + renderExpression(e[1])
+
+    return '(%s %s %s)' % (renderExpression(e[1]), kind, renderExpression(e[2]))
+
+
+def renderTop(e):
+    # without the parentheses around the whole expression
+    source = renderExpression(e)
+    if len(e) == 3:
+        return source[1:-1]
+    return source
+
+
+def render(statements, indent=0):
+    pad = '    ' * indent
+    lines = []
+
+    for s in statements:
+        if s[0] == 'assign':
+            lines.append('%s%s = %s;' % (pad, s[1], renderTop(s[2])))
+        elif s[0] == 'block':
+            lines.append(render(s[1], indent))
+        elif s[0] == 'while':
+            lines.append('%swhile(%s)' % (pad, renderTop(s[1])))
+            lines.append('%s{' % pad)
+            lines.append(render(s[2], indent + 1))
+            lines.append('%s}' % pad)
+        else:
+            for k, (cond, block) in enumerate(s[1]):
+                lines.append('%s%s(%s)' % (pad, 'if' if k == 0 else 'else if',
+                                           renderTop(cond)))
+                lines.append('%s{' % pad)
+                lines.append(render(block, indent + 1))
+                lines.append('%s}' % pad)
+            if s[2] is not None:
+                lines.append('%selse' % pad)
+                lines.append('%s{' % pad)
+                lines.append(render(s[2], indent + 1))
+                lines.append('%s}' % pad)
+
+    return '\n'.join(line for line in lines if line)
+
+
+class Evaluator:
+    # Reference semantics of the generated programs, on python integers.
+    # Raises BudgetExceededError after budget statements, as State would
+    # stop long programs with InfiniteLoopError.
+    def __init__(self, budget=1000):
+        self.budget = budget
+        self.executed = 0
+        self.values = {}
+
+    def run(self, statements):
+        for s in statements:
+            self.executed += 1
+            if self.executed > self.budget:
+                raise BudgetExceededError()
+
+            if s[0] == 'assign':
+                self.values[s[1]] = self.expression(s[2])
+            elif s[0] == 'block':
+                self.run(s[1])
+            elif s[0] == 'while':
+                while self.condition(s[1]):
+                    self.run(s[2])
+            else:
+                for cond, block in s[1]:
+                    if self.condition(cond):
+                        self.run(block)
+                        break
+                else:
+                    if s[2] is not None:
+                        self.run(s[2])
+
+        return self.values
+
+    def expression(self, e):
+        kind = e[0]
+        if kind == 'int':
+            return e[1]
+        elif kind == 'var':
+            return self.values[e[1]]
+        elif kind == 'neg':
+            return -self.expression(e[1])
+        elif kind == 'not':
+            return ~self.expression(e[1])
+        elif kind == '+':
+            return self.expression(e[1]) + self.expression(e[2])
+
+        return self.expression(e[1]) - self.expression(e[2])
+
+    def condition(self, c):
+        kind = c[0]
+        if kind == '&&':
+            return self.condition(c[1]) and self.condition(c[2])
+        elif kind == '||':
+            return self.condition(c[1]) or self.condition(c[2])
+
+        return comparisons[kind](self.expression(c[1]), self.expression(c[2]))
+
+
+def programs(seed=0, count=10, budget=1000, **options):
+    # (source, expected values of the variables) of count programs which
+    # run at most budget statements
+    generator = Generator(seed, **options)
+
+    while count > 0:
+        program = generator.program()
+        try:
+            values = Evaluator(budget).run(program)
+        except BudgetExceededError:
+            continue
+
+        count -= 1
+        yield render(program), values
+
+
+def check(corpus):
+    # runs the programs with the student compiler, as test.py does:
+    # every value must be in a register. Returns the failures and the
+    # number of programs per second
+    from test_utils import run
+
+    failures = []
+    start = time.time()
+    for k, (source, expected) in enumerate(corpus):
+        try:
+            state = run(source, execute=True)
+
+            values = list(state.registers.values())
+            missing = [v for v in expected if expected[v] not in values]
+            if missing:
+                failures.append((k, source, 'wrong values: %s' % ', '.join(missing)))
+        except Exception as e:
+            failures.append((k, source, '%s: %s' % (type(e).__name__, e)))
+
+    return failures, len(corpus) / max(time.time() - start, 1e-9)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generates random Mu programs with their expected results")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-n', '--count', type=int, default=10)
+    parser.add_argument('--statements', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--budget', type=int, default=1000,
+                        help="maximum number of statements executed")
+    parser.add_argument('--no-logic', action='store_true',
+                        help="no && or || in the conditions")
+    parser.add_argument('--check', action='store_true',
+                        help="run them with the compiler found in PYTHONPATH")
+    args = parser.parse_args()
+
+    corpus = list(programs(args.seed, args.count, args.budget,
+                           statements=args.statements, depth=args.depth,
+                           logic=not args.no_logic))
+
+    if not args.check:
+        for source, expected in corpus:
+            print(source)
+            print('// %r' % sorted(expected.items()))
+            print()
+        return
+
+    failures, rate = check(corpus)
+    for k, source, reason in failures:
+        print('program %d: %s' % (k, reason), file=sys.stderr)
+        print(source, file=sys.stderr)
+
+    print('%d programs, %d failed, %.1f programs/s' % (len(corpus), len(failures), rate))
+
+if __name__ == '__main__':
+    # without arguments, runs its tests
+    if len(sys.argv) > 1:
+        main()
+        sys.exit()
+
+    import unittest
+
+    class Test(unittest.TestCase):
+        def test_deterministic(self):
+            self.assertEqual(list(programs(3, 5)), list(programs(3, 5)))
+            self.assertNotEqual(list(programs(3, 5)), list(programs(4, 5)))
+
+        def test_evaluator(self):
+            program = [('assign', 'a', ('int', 0)),
+                       ('assign', 'n', ('int', 3)),
+                       ('while', ('<', ('var', 'a'), ('var', 'n')),
+                        [('assign', 'a', ('+', ('var', 'a'), ('int', 1)))]),
+                       ('if', [(('==', ('var', 'a'), ('int', 2)),
+                                [('assign', 'b', ('int', 1))]),
+                               (('&&', ('>', ('var', 'a'), ('int', 2)),
+                                 ('<', ('var', 'a'), ('int', 4))),
+                                [('assign', 'b', ('not', ('var', 'n')))])],
+                        [('assign', 'b', ('int', 3))])]
+
+            self.assertEqual(Evaluator().run(program),
+                             {'a': 3, 'n': 3, 'b': -4})
+            self.assertEqual(render(program[2:3]),
+                             'while(a < n)\n{\n    a = a + 1;\n}')
+
+        def test_budget(self):
+            for source, expected in programs(0, 20, 50, statements=10):
+                self.assertTrue(source.startswith('v0 = '))
+
+            with self.assertRaises(BudgetExceededError):
+                Evaluator(2).run([('assign', 'a', ('int', 0))] * 3)
+
+        def test_large(self):
+            source, expected = next(programs(1, 1, 10 ** 5, statements=300,
+                                              depth=4))
+            self.assertGreater(source.count(';'), 300)
+
+    unittest.main()
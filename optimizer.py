@@ -0,0 +1,284 @@
+from __future__ import print_function
+
+from customprog import (State, Program, Label, Br, OP_NOP, OP_LABEL, OP_BR,
+                        ALWAYS, InfiniteLoopError)
+
+
+class OptimizationMismatchError(Exception):
+    pass
+
+
+class Optimized:
+    # Instructions of a program without its no-ops, and the bound on the
+    # instructions the original program executes: at most
+    # start + weight * (instructions executed by the optimized one)
+    def __init__(self, instrs, start, weight):
+        self.instrs = instrs
+        self.start = start
+        self.weight = weight
+
+
+def optimize(instrs):
+    # Labels, comments and unconditional branches do nothing but move
+    # the pc, and cost one instruction each. Every branch and fall
+    # through is resolved to the first real instruction it reaches, so
+    # that at once:
+    # - chains of unconditional branches are threaded
+    # - the code which no resolved edge reaches is removed
+    # - labels are only kept, one per target, where a branch lands
+    # Returns None when the program cannot be optimized: linking errors,
+    # or a reachable loop made of no-ops only.
+    program = Program(instrs)
+    if program.linkError is not None:
+        return None
+
+    ops, drs, sr1s = program.ops, program.dr, program.sr1
+    end = len(ops)
+
+    # pc: (first real instruction reached from pc, or end, no-ops
+    # executed on the way)
+    resolved = {end: (end, 0)}
+
+    def resolve(pc):
+        path = []
+        visited = set()
+        while pc not in resolved:
+            op = ops[pc]
+            if op in (OP_NOP, OP_LABEL):
+                nextPc = pc + 1
+            elif op == OP_BR and drs[pc] == ALWAYS:
+                nextPc = sr1s[pc]
+            else:
+                resolved[pc] = (pc, 0)
+                break
+
+            if pc in visited:
+                return None
+
+            path.append(pc)
+            visited.add(pc)
+            pc = nextPc
+
+        target, distance = resolved[pc]
+        for pc in reversed(path):
+            distance += 1
+            resolved[pc] = (target, distance)
+
+        return resolved[path[0]] if path else resolved[pc]
+
+    def successors(pc):
+        if ops[pc] == OP_BR:
+            return [resolve(pc + 1), resolve(sr1s[pc])]
+        return [resolve(pc + 1)]
+
+    entry = resolve(0)
+    if entry is None:
+        return None
+
+    kept = set()
+    weight = 1
+    stack = [entry[0]]
+    while stack:
+        pc = stack.pop()
+        if pc == end or pc in kept:
+            continue
+        kept.add(pc)
+
+        for successor in successors(pc):
+            if successor is None:
+                return None
+
+            weight = max(weight, 1 + successor[1])
+            stack.append(successor[0])
+
+    order = sorted(kept)
+
+    def label(pc):
+        return 'opt_%d' % pc
+
+    # targets of branches, and of fall throughs which are not next
+    targets = set()
+    fallthroughs = {}
+    for idx, pc in enumerate(order):
+        following = order[idx + 1] if idx + 1 < len(order) else end
+        fallthrough = resolve(pc + 1)[0]
+        if fallthrough != following:
+            fallthroughs[pc] = fallthrough
+            targets.add(fallthrough)
+        if ops[pc] == OP_BR:
+            targets.add(resolve(sr1s[pc])[0])
+
+    result = []
+    if order[:1] != [entry[0]]:
+        targets.add(entry[0])
+        result.append(Br("", label(entry[0])))
+
+    for pc in order:
+        if pc in targets:
+            result.append(Label(label(pc)))
+
+        if ops[pc] == OP_BR:
+            result.append(Br(instrs[pc].s, label(resolve(sr1s[pc])[0])))
+        else:
+            result.append(instrs[pc])
+
+        if pc in fallthroughs:
+            result.append(Br("", label(fallthroughs[pc])))
+
+    if end in targets:
+        result.append(Label(label(end)))
+
+    return Optimized(result, entry[1], weight)
+
+
+class OptimizedState(State):
+    # State which runs the optimized program instead, when it is certain
+    # to end as the original one: same registers, same last register and
+    # same error. The original program is run when the optimized one
+    # loops, as the original may have reached maxInstructions earlier,
+    # or when the bound on the original instructions exceeds it.
+    def __init__(self, instrs, maxInstructions=100000, program=None,
+                 detectLoops=False):
+        State.__init__(self, instrs, maxInstructions, program, detectLoops)
+
+        self.optimized = optimize(instrs)
+
+    def run(self):
+        self.program.checkLinked()
+
+        optimized = self.optimized
+        if optimized is None:
+            return State.run(self)
+
+        state = State(optimized.instrs, self.maxInstructions,
+                      detectLoops=self.detectLoops)
+        error = None
+        try:
+            state.run()
+        except InfiniteLoopError:
+            return State.run(self)
+        except Exception as e:
+            error = e
+
+        bound = optimized.start + optimized.weight * state.executed
+        if bound > self.maxInstructions:
+            return State.run(self)
+
+        for r, value in state.registers.items():
+            self.values[self.program.registerSlots[r]] = value
+        self.lastRegister = state.lastRegister
+        self.executed = state.executed
+
+        if error is not None:
+            raise error
+
+
+def outcome(state):
+    # what a test can see of a run
+    try:
+        state.run()
+        error = None
+    except Exception as e:
+        error = type(e).__name__
+
+    return error, dict(state.registers), state.lastRegister
+
+
+def diffRuns(instrs, maxInstructions=100000, detectLoops=False):
+    # differences between the runs of a program by State and by
+    # OptimizedState, as lines
+    original = outcome(State(instrs, maxInstructions,
+                             detectLoops=detectLoops))
+    optimized = outcome(OptimizedState(instrs, maxInstructions,
+                                       detectLoops=detectLoops))
+
+    lines = []
+    for name, a, b in zip(['error', 'registers', 'lastRegister'],
+                          original, optimized):
+        if a != b:
+            lines.append('%s: %r != %r (optimized)' % (name, a, b))
+
+    return lines
+
+
+class ValidatingState(OptimizedState):
+    # OptimizedState which runs the original program too, and raises
+    # OptimizationMismatchError if they do not end the same way
+    def run(self):
+        lines = diffRuns(self.instrs, self.maxInstructions, self.detectLoops)
+        if lines:
+            raise OptimizationMismatchError('\n'.join(lines))
+
+        return OptimizedState.run(self)
+
+if __name__ == '__main__':
+    import unittest
+
+    from customprog import And, Add, Not, Comment
+
+    r0 = "temp_0"
+    r1 = "temp_1"
+    r2 = "temp_2"
+
+    class Test(unittest.TestCase):
+        def _check(self, instrs, maxInstructions=100000, detectLoops=False):
+            self.assertEqual(diffRuns(instrs, maxInstructions, detectLoops),
+                             [])
+
+        def test_threading(self):
+            instrs = [And(r0, r0, 0),
+                      Br("z", "a"),
+                      Not(r1, r0),
+                      Label("a"),
+                      Br("", "b"),
+                      Add(r1, r1, 1),
+                      Label("b"),
+                      Label("c"),
+                      Comment("end"),
+                      Add(r2, r0, 3)]
+            optimized = optimize(instrs)
+
+            self.assertEqual([type(i).__name__ for i in optimized.instrs],
+                             ['And', 'Br', 'Not', 'Label', 'Add'])
+            self.assertEqual(optimized.instrs[1].label,
+                             optimized.instrs[3].label)
+            # from Br z to Add: 2 labels, Br, 2 labels and a comment
+            self.assertEqual(optimized.weight, 6)
+            self._check(instrs)
+
+        def test_loops(self):
+            for start in range(-2, 5):
+                self._check([And(r0, r0, 0), Add(r0, r0, start),
+                             Label("loop"),
+                             Br("", "test"),
+                             Label("body"),
+                             Add(r0, r0, -1),
+                             Add(r1, r0, 0),
+                             Label("test"),
+                             Br("p", "body"),
+                             Not(r2, r0)])
+
+        def test_infinite_loops(self):
+            self._check([Label("l"), Br("", "l")])
+            self._check([And(r0, r0, 0), Label("l"), Add(r0, r0, 1),
+                         Br("", "l")], 50)
+            self._check([And(r0, r0, 0), Label("l"), Add(r0, r0, 1),
+                         And(r0, r0, 3), Br("", "l")], 10 ** 9, True)
+
+        def test_max_instructions(self):
+            # the optimized program ends within 40 instructions, not
+            # the original
+            instrs = [And(r0, r0, 0), Add(r0, r0, 10),
+                      Label("loop"),
+                      Label("useless"),
+                      Add(r0, r0, -1),
+                      Br("p", "loop")]
+            for maxInstructions in [20, 40, 45]:
+                self._check(instrs, maxInstructions)
+
+        def test_errors(self):
+            self._check([Br("", "l"), Label("l"), Add(r0, r1, 1)])
+            self._check([Br("z", "missing")])
+            self._check([Label("l"), Label("l")])
+
+    unittest.main()
@@ -0,0 +1,184 @@
+from __future__ import print_function
+
+import sys
+import argparse
+import unittest
+import multiprocessing
+
+import test
+from test_utils import PhaseTimes
+
+
+def _runMethod(name):
+    # (label, traceback) of the error of the method, or None
+    result = test.GradingResult(sys.stderr, False, 0)
+    test.TestCase(name).run(result)
+
+    problems = result.failures + result.errors
+    if not problems:
+        return None
+
+    traceback = problems[0][1]
+    return test.errorLabel(result.exceptions.get(name), traceback), traceback
+
+
+def discover(name):
+    # The rangeGroup calls of a method, or None if it cannot be split
+    # into its cases: the method is run with a rangeGroup which records
+    # the cases and returns nothing. That run is never graded, as the
+    # method did not run any of its cases.
+    rangeGroup = test.rangeGroup
+    recorded = []
+
+    def recorder(*args):
+        recorded.append(list(rangeGroup(*args)))
+        return []
+
+    test.rangeGroup = recorder
+    try:
+        error = _runMethod(name)
+    finally:
+        test.rangeGroup = rangeGroup
+        test.timings.pop(name, None)
+
+    if error is not None:
+        # it may not have reached all its rangeGroup calls
+        return name, None
+
+    return name, recorded
+
+
+def runItem(item):
+    # A work item is a test method and one of its rangeGroup cases, or
+    # the whole method when case is None. The method runs once per case:
+    # what it does outside its rangeGroup loop is done for every case
+    name, case = item
+    rangeGroup = test.rangeGroup
+
+    if case is not None:
+        test.rangeGroup = lambda *args: [case]
+
+    try:
+        error = _runMethod(name)
+    finally:
+        test.rangeGroup = rangeGroup
+
+    return name, case, error, test.timings.pop(name, PhaseTimes())
+
+
+def runAll(jobs):
+    # returns the tests in error and the phases of each test, as
+    # expected by test.writeResults, and the number of work items
+    pool = multiprocessing.Pool(jobs)
+
+    # errors of each method, by index of the case
+    errors = dict((name, {}) for name in test.testNames())
+    timings = dict((name, PhaseTimes()) for name in errors)
+    items = []
+
+    for name, recorded in pool.imap_unordered(discover, list(errors),
+                                              chunksize=1):
+        if recorded is not None and len(recorded) == 1:
+            # each case is run by its own worker, in any order
+            cases = list(enumerate(recorded[0]))
+        else:
+            # several loops, or none: the method is run as a whole
+            cases = [(0, None)]
+
+        for idx, case in cases:
+            items.append((name, idx,
+                          pool.apply_async(runItem, [(name, case)])))
+
+    for name, idx, result in items:
+        _, _, error, times = result.get()
+        timings[name].add(times)
+        if error is not None:
+            errors[name][idx] = error
+
+    pool.close()
+    pool.join()
+
+    errTests = {}
+    for name, failures in sorted(errors.items()):
+        if failures:
+            # the first failing case is the one a serial run would report
+            errTests[name], traceback = failures[min(failures)]
+
+            print('=' * 70, file=sys.stderr)
+            print('FAIL: %s' % name, file=sys.stderr)
+            print('-' * 70, file=sys.stderr)
+            print(traceback, file=sys.stderr)
+
+    return errTests, timings, len(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs test.py with one work item per rangeGroup case")
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--slowest', type=int, default=10,
+                        help="number of tests in the slowest tests report")
+    args = parser.parse_args()
+
+    errTests, timings, nbItems = runAll(args.jobs)
+
+    print('Ran %d tests (%d cases), %d failed' % (len(test.testNames()),
+                                                  nbItems, len(errTests)),
+          file=sys.stderr)
+
+    print('Slowest tests:', file=sys.stderr)
+    for line in test.slowestTests(timings, args.slowest):
+        print(line, file=sys.stderr)
+
+    test.writeResults(errTests, timings)
+
+if __name__ == '__main__':
+    # without arguments, runs its tests, which need the student files
+    # too, as test.py
+    if len(sys.argv) > 1:
+        main()
+        sys.exit()
+
+    class Test(unittest.TestCase):
+        def test_run_all(self):
+            # a subclass of test.TestCase, defined here as unittest
+            # would run all its tests
+            class Sample(test.TestCase):
+                def test_cases(self):
+                    for i in test.rangeGroup([(0, 4)]):
+                        self.assertNotEqual(i, 2)
+
+                def test_twice(self):
+                    for i in test.rangeGroup([(0, 3)]):
+                        pass
+                    for i in test.rangeGroup([(0, 3)]):
+                        self.assertNotEqual(i, 1)
+
+                def test_after_loop(self):
+                    seen = []
+                    for i in test.rangeGroup([(0, 3)]):
+                        seen.append(i)
+                    self.assertTrue(seen)
+
+                def test_no_loop(self):
+                    pass
+
+            testCase, testNames = test.TestCase, test.testNames
+            rangeGroup = test.rangeGroup
+            test.TestCase = Sample
+            test.testNames = lambda: ['test_after_loop', 'test_cases',
+                                      'test_no_loop', 'test_twice']
+            # all the cases, whatever FAST
+            test.rangeGroup = lambda args: list(range(*args[0]))
+            try:
+                errTests, timings, nbItems = runAll(2)
+            finally:
+                test.TestCase, test.testNames = testCase, testNames
+                test.rangeGroup = rangeGroup
+
+            self.assertEqual(sorted(errTests), ['test_cases', 'test_twice'])
+            # the 4 cases, and the 3 other methods as a whole
+            self.assertEqual(nbItems, 7)
+
+    unittest.main()
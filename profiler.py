@@ -0,0 +1,126 @@
+from __future__ import print_function
+
+from customprog import State, Comment, Label, And, Add, Not, Br
+
+opcodeNames = dict((cls.opcode, cls.__name__)
+                   for cls in [Comment, Label, And, Add, Not, Br])
+
+
+class ProfiledState(State):
+    # State which counts the executions of each pc and of each back-edge.
+    # It runs one instruction at a time through State._interpret, so
+    # State itself does not pay anything for profiling.
+    def __init__(self, instrs, maxInstructions=100000, program=None,
+                 detectLoops=False):
+        State.__init__(self, instrs, maxInstructions, program, detectLoops)
+
+        self.hits = [0] * len(self.program.ops)
+        # (pc of the branch, pc of its target): times taken
+        self.backEdges = {}
+
+    def run(self):
+        self.program.checkLinked()
+
+        hits = self.hits
+        backEdges = self.backEdges
+        count = 0
+        pc = 0
+        while pc < len(hits):
+            hits[pc] += 1
+            nextPc = self._interpret(pc, count, count + 1)
+            count += 1
+
+            # only taken branches go backward
+            if nextPc <= pc:
+                edge = (pc, nextPc)
+                backEdges[edge] = backEdges.get(edge, 0) + 1
+
+            pc = nextPc
+
+    def opcodeCounts(self):
+        counts = {}
+        for op, hits in zip(self.program.ops, self.hits):
+            name = opcodeNames[op]
+            counts[name] = counts.get(name, 0) + hits
+
+        return counts
+
+    def hottestLoops(self, n=5):
+        # back-edges by number of iterations, with the instructions
+        # executed in their body
+        loops = []
+        for (branch, target), iterations in sorted(self.backEdges.items(),
+                                                   key=lambda e: -e[1])[:n]:
+            body = sum(self.hits[target:branch + 1])
+            loops.append((branch, target, iterations, body))
+
+        return loops
+
+    def report(self, n=5):
+        lines = ['%d instructions executed' % sum(self.hits)]
+
+        counts = self.opcodeCounts()
+        lines.append(', '.join('%s: %d' % (name, counts[name])
+                               for name in sorted(counts)))
+
+        for branch, target, iterations, body in self.hottestLoops(n):
+            lines.append('loop from pc %d to pc %d: %d iterations, '
+                         '%d instructions in its body' %
+                         (target, branch, iterations, body))
+
+        lines.append('')
+        for pc, instr in enumerate(self.instrs):
+            lines.append('%8d  %4d  %r' % (self.hits[pc], pc, instr))
+
+        return lines
+
+if __name__ == '__main__':
+    import unittest
+
+    from customprog import InfiniteLoopError
+
+    r0 = "temp_0"
+    r1 = "temp_1"
+
+    class Test(unittest.TestCase):
+        def _countdown(self, start):
+            return [And(r0, r0, 0),
+                    Add(r0, r0, start),
+                    Label("loop"),
+                    Add(r0, r0, -1),
+                    Br("p", "loop"),
+                    Not(r1, r0)]
+
+        def test_same_as_state(self):
+            instrs = self._countdown(4)
+            state = State(instrs)
+            state.run()
+            profiled = ProfiledState(instrs)
+            profiled.run()
+
+            self.assertEqual(dict(profiled.registers), dict(state.registers))
+            self.assertEqual(profiled.executed, state.executed)
+            self.assertEqual(sum(profiled.hits), state.executed)
+
+        def test_counts(self):
+            state = ProfiledState(self._countdown(4))
+            state.run()
+
+            self.assertEqual(state.hits, [1, 1, 4, 4, 4, 1])
+            self.assertEqual(state.opcodeCounts(),
+                             {'And': 1, 'Add': 5, 'Label': 4, 'Br': 4,
+                              'Not': 1})
+            self.assertEqual(state.backEdges, {(4, 2): 3})
+            self.assertEqual(state.hottestLoops(), [(4, 2, 3, 12)])
+            self.assertIn("       4     3  Add(dr='temp_0', "
+                          "sr1='temp_0', sr2orimm7=-1)", state.report())
+
+        def test_infinite_loop(self):
+            state = ProfiledState([Label("start"), Br("", "start")], 10)
+
+            with self.assertRaises(InfiniteLoopError):
+                state.run()
+
+            self.assertEqual(state.hits, [6, 5])
+
+    unittest.main()
@@ -0,0 +1,393 @@
+from __future__ import print_function
+
+import os
+import sys
+import mmap
+import time
+import struct
+import argparse
+import tempfile
+from array import array
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+from customprog import (Program, State, Comment, Label, And, Add, Not, Br,
+                        OP_NOP, OP_LABEL, OP_AND, OP_NOT, OP_BR,
+                        DuplicateLabelError, MissingLabelError)
+
+# Programs on disk, as the columns of customprog.Program:
+# - header: magic, version, instructions, strings, registers
+# - string table: the length of each string, then the strings in utf8.
+#   The registers come first, in the order of their slots
+# - fixed-width columns of one field of all the instructions, aligned:
+#   dr, sr1, sr2, name (32 bits) then ops, imm, fused, cond (8 bits)
+# name is the string of the label of Label and Br, and of the text of
+# Comment. cond is the letters of the condition of Br, as an NZP mask.
+# The loader gives the mapped columns to Program without copying them,
+# when python has memoryview.cast (python 3) and the machine is little
+# endian; otherwise they are copied.
+magic = b'MUPG'
+version = 1
+header = struct.Struct('<4sHxxIII')
+
+letters = (('n', 4), ('z', 2), ('p', 1))
+
+assert array('i').itemsize == 4 and array('I').itemsize == 4
+
+
+class ProgramFormatError(Exception):
+    pass
+
+
+def _decode(data):
+    s = data.decode('utf8')
+    try:
+        # str on python 2 too, when possible
+        return str(s)
+    except UnicodeEncodeError:
+        return s
+
+
+def _encode(s):
+    if not isinstance(s, bytes):
+        s = u'%s' % (s,)
+        return s.encode('utf8')
+    return s
+
+
+def _pad(n):
+    return -n % 4
+
+
+def _toBytes(column):
+    if hasattr(column, 'tobytes'):
+        return column.tobytes()
+    return column.tostring()
+
+
+def _fromBytes(typecode, data):
+    column = array(typecode)
+    if hasattr(column, 'frombytes'):
+        column.frombytes(data)
+    else:
+        column.fromstring(data)
+    if sys.byteorder != 'little':
+        column.byteswap()
+
+    return column
+
+
+def dumps(instrs):
+    program = Program(instrs)
+
+    strings = [_encode(r) for r in program.registerNames]
+    slots = {}
+    names = []
+    conds = []
+    for instr in instrs:
+        op = instr.opcode
+        name = 0
+        cond = 0
+        if op == OP_LABEL or op == OP_BR or op == OP_NOP:
+            s = _encode(instr.s if op == OP_NOP else instr.label)
+            if s not in slots:
+                slots[s] = len(strings)
+                strings.append(s)
+            name = slots[s]
+        if op == OP_BR:
+            cond = sum(mask for letter, mask in letters if letter in instr.s)
+        names.append(name)
+        conds.append(cond)
+
+    try:
+        words = [array('i', column) for column in
+                 [program.dr, program.sr1, program.sr2, names]]
+    except OverflowError:
+        raise ProgramFormatError('operand over 32 bits')
+    if sys.byteorder != 'little':
+        for column in words:
+            column.byteswap()
+
+    parts = [header.pack(magic, version, len(instrs), len(strings),
+                         len(program.registerNames))]
+    lengths = array('I', [len(s) for s in strings])
+    if sys.byteorder != 'little':
+        lengths.byteswap()
+    parts.append(_toBytes(lengths))
+    table = b''.join(strings)
+    parts.append(table + b'\0' * _pad(len(table)))
+
+    for column in words:
+        parts.append(_toBytes(column))
+    for column in [program.ops, program.imm, program.fused, conds]:
+        parts.append(bytes(bytearray(column)))
+
+    return b''.join(parts)
+
+
+def save(instrs, path):
+    # written to a temporary file then renamed, as CompileCache does
+    data = dumps(instrs)
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+class Instructions(Sequence):
+    # instructions of a loaded program, only built when read, as State
+    # only runs the columns
+    def __init__(self, program, strings, names, conds):
+        self.program = program
+        self.strings = strings
+        self.names = names
+        self.conds = conds
+
+    def __len__(self):
+        return len(self.program.ops)
+
+    def __getitem__(self, pc):
+        if isinstance(pc, slice):
+            return [self[i] for i in range(*pc.indices(len(self)))]
+        if pc < 0:
+            pc += len(self)
+
+        program = self.program
+        op = program.ops[pc]
+        if op == OP_NOP:
+            return Comment(self.strings[self.names[pc]])
+        elif op == OP_LABEL:
+            return Label(self.strings[self.names[pc]])
+        elif op == OP_BR:
+            s = ''.join(letter for letter, mask in letters
+                        if self.conds[pc] & mask)
+            return Br(s, self.strings[self.names[pc]])
+
+        dr = program.registerNames[program.dr[pc]]
+        sr1 = program.registerNames[program.sr1[pc]]
+        if op == OP_NOT:
+            return Not(dr, sr1)
+
+        sr2 = program.sr2[pc]
+        if not program.imm[pc]:
+            sr2 = program.registerNames[sr2]
+        return (And if op == OP_AND else Add)(dr, sr1, sr2)
+
+
+def _columns(data, offset, n):
+    # the 4 columns of 32 bits then the 4 columns of 8 bits from offset
+    view = memoryview(data)
+    zeroCopy = hasattr(view, 'cast') and sys.byteorder == 'little'
+
+    columns = []
+    for k in range(4):
+        chunk = view[offset + 4 * n * k:offset + 4 * n * (k + 1)]
+        if zeroCopy:
+            columns.append(chunk.cast('i'))
+        else:
+            columns.append(_fromBytes('i', chunk.tobytes()))
+
+    offset += 16 * n
+    for k in range(4):
+        chunk = view[offset + n * k:offset + n * (k + 1)]
+        columns.append(chunk if zeroCopy else array('B', chunk.tobytes()))
+
+    return columns
+
+
+def loads(data):
+    # (Program, Instructions) of a program saved by dump, data is any
+    # buffer: the columns are views of it when possible
+    if len(data) < header.size:
+        raise ProgramFormatError('truncated header')
+
+    tag, fileVersion, n, nStrings, nRegisters = header.unpack_from(data, 0)
+    if tag != magic or fileVersion != version:
+        raise ProgramFormatError('not a program of version %d' % version)
+
+    offset = header.size
+    if len(data) < offset + 4 * nStrings:
+        raise ProgramFormatError('truncated string table')
+    lengths = struct.unpack_from('<%dI' % nStrings, data, offset)
+    offset += 4 * nStrings
+
+    strings = []
+    for length in lengths:
+        strings.append(_decode(bytes(data[offset:offset + length])))
+        offset += length
+    offset += _pad(offset)
+
+    if len(data) < offset + 20 * n:
+        raise ProgramFormatError('truncated columns')
+
+    dr, sr1, sr2, names, ops, imm, fused, conds = _columns(data, offset, n)
+
+    # linking errors as Program finds them: duplicate labels first
+    labels = {}
+    linkError = None
+    for pc in range(n):
+        if ops[pc] == OP_LABEL:
+            label = strings[names[pc]]
+            if label in labels and linkError is None:
+                linkError = DuplicateLabelError(label)
+            labels[label] = pc
+
+    if linkError is None:
+        for pc in range(n):
+            if ops[pc] == OP_BR and sr1[pc] == -1:
+                linkError = MissingLabelError(strings[names[pc]])
+                break
+
+    program = Program.fromColumns(ops, dr, sr1, sr2, imm, fused,
+                                  strings[:nRegisters], labels, linkError)
+
+    return program, Instructions(program, strings, names, conds)
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        if hasattr(memoryview, 'cast'):
+            # the mapping stays open while the columns use it
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = f.read()
+
+    return loads(data)
+
+
+def loadState(path, maxInstructions=100000, detectLoops=False):
+    program, instrs = load(path)
+
+    return State(instrs, maxInstructions, program, detectLoops)
+
+
+def _paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.mup'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs programs saved by programfile.save")
+    parser.add_argument('paths', nargs='+',
+                        help="program files, or directories of .mup files")
+    parser.add_argument('--max-instructions', type=int, default=100000)
+    parser.add_argument('--detect-loops', action='store_true')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="only the summary")
+    args = parser.parse_args()
+
+    count = 0
+    errors = 0
+    start = time.time()
+    for path in _paths(args.paths):
+        count += 1
+        try:
+            state = loadState(path, args.max_instructions, args.detect_loops)
+            state.run()
+            result = repr(state.registers)
+        except Exception as e:
+            errors += 1
+            result = '%s: %s' % (type(e).__name__, e)
+
+        if not args.quiet:
+            print('%s: %s' % (path, result))
+
+    elapsed = time.time() - start
+    print('%d programs, %d errors, %.3fs' % (count, errors, elapsed),
+          file=sys.stderr)
+
+if __name__ == '__main__':
+    # without arguments, runs its tests
+    if len(sys.argv) > 1:
+        main()
+        sys.exit()
+
+    import shutil
+    import unittest
+
+    r0 = "temp_0"
+    r1 = "temp_1"
+
+    class Test(unittest.TestCase):
+        instrs = [Comment("start"),
+                  And(r0, r0, 0),
+                  Add(r0, r0, 3),
+                  Label("loop"),
+                  Add(r0, r0, -1),
+                  Not(r1, r0),
+                  Br("p", "loop"),
+                  Br("", "end"),
+                  Br("nzp", "end"),
+                  And(r1, r1, r0),
+                  Label("end")]
+
+        def setUp(self):
+            self.directory = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.directory)
+
+        def _roundTrip(self, instrs):
+            path = os.path.join(self.directory, 'p.mup')
+            save(instrs, path)
+            return load(path)
+
+        def test_round_trip(self):
+            program, instrs = self._roundTrip(self.instrs)
+            original = Program(self.instrs)
+
+            self.assertEqual([repr(i) for i in instrs],
+                             [repr(i) for i in self.instrs])
+            for column in ['ops', 'dr', 'sr1', 'sr2', 'imm', 'fused']:
+                self.assertEqual(list(getattr(program, column)),
+                                 list(getattr(original, column)))
+            self.assertEqual(program.registerNames, original.registerNames)
+            self.assertEqual(program.labels, original.labels)
+
+        def test_run(self):
+            path = os.path.join(self.directory, 'p.mup')
+            save(self.instrs, path)
+            state = loadState(path)
+            state.run()
+
+            expected = State(self.instrs)
+            expected.run()
+            self.assertEqual(dict(state.registers), dict(expected.registers))
+            self.assertEqual(state.executed, expected.executed)
+
+        def test_link_errors(self):
+            program, _ = self._roundTrip([Br("z", "missing"), Label("a"),
+                                          Label("a")])
+            with self.assertRaises(DuplicateLabelError):
+                program.checkLinked()
+
+            program, _ = self._roundTrip([Br("z", "missing")])
+            with self.assertRaises(MissingLabelError):
+                program.checkLinked()
+
+        def test_bad_files(self):
+            with self.assertRaises(ProgramFormatError):
+                loads(b'MUPG')
+            with self.assertRaises(ProgramFormatError):
+                loads(dumps(self.instrs)[:24])
+            with self.assertRaises(ProgramFormatError):
+                loads(dumps(self.instrs)[:-1])
+            with self.assertRaises(ProgramFormatError):
+                dumps([And(r0, r0, 0), Add(r0, r0, 2 ** 40)])
+
+    unittest.main()
@@ -0,0 +1,112 @@
+from __future__ import print_function
+
+import random
+
+# largest immediate value of CustomProg, results over it must be built
+# from registers
+maxImmediate = 15
+
+
+def _sign(x):
+    return (x > 0) - (x < 0)
+
+
+def caseClass(values, ranges):
+    # equivalence class of a case of rangeGroup: where each value is in
+    # its range, how the values compare, and whether their sum still
+    # fits in an immediate
+    positions = []
+    for v, (low, high) in zip(values, ranges):
+        if v == 0:
+            positions.append('zero')
+        elif v == low:
+            positions.append('low')
+        elif v == high - 1:
+            positions.append('high')
+        else:
+            positions.append('mid')
+
+    signs = [_sign(values[a] - values[b])
+             for a in range(len(values)) for b in range(a + 1, len(values))]
+
+    return tuple(positions), tuple(signs), sum(values) > maxImmediate
+
+
+def _edges(key):
+    # the more boundaries a class touches, the sooner it is sampled
+    positions, signs, overflow = key
+    return (sum(p != 'mid' for p in positions) + signs.count(0) +
+            int(overflow))
+
+
+def stratifiedSample(cases, ranges, limit, seed=0):
+    # Deterministic sample of limit cases of rangeGroup(ranges): one
+    # case of each class of caseClass, the classes on the most
+    # boundaries first, then more cases of each class in turn.
+    cases = list(cases)
+    rng = random.Random(seed)
+
+    classes = {}
+    for idx, case in enumerate(cases):
+        values = case if isinstance(case, tuple) else (case,)
+        classes.setdefault(caseClass(values, ranges), []).append(idx)
+
+    keys = sorted(classes)
+    rng.shuffle(keys)
+    keys.sort(key=_edges, reverse=True)
+
+    for key in keys:
+        rng.shuffle(classes[key])
+
+    chosen = []
+    rank = 0
+    while len(chosen) < min(limit, len(cases)):
+        for key in keys:
+            if rank < len(classes[key]) and len(chosen) < limit:
+                chosen.append(classes[key][rank])
+        rank += 1
+
+    return [cases[idx] for idx in sorted(chosen)]
+
+if __name__ == '__main__':
+    import unittest
+    import itertools
+
+    class Test(unittest.TestCase):
+        def _sample(self, ranges, limit, seed=0):
+            cases = list(itertools.product(*[range(*r) for r in ranges]))
+            return stratifiedSample(cases, ranges, limit, seed)
+
+        def test_deterministic(self):
+            ranges = [(0, 15), (0, 15)]
+            self.assertEqual(self._sample(ranges, 10), self._sample(ranges, 10))
+            self.assertEqual(len(self._sample(ranges, 10)), 10)
+            self.assertEqual(len(set(self._sample(ranges, 300))), 225)
+
+        def test_boundaries(self):
+            sample = self._sample([(0, 15), (0, 15)], 30)
+
+            self.assertIn((0, 0), sample)
+            self.assertIn((14, 14), sample)
+            self.assertTrue(any(i == j for i, j in sample if 0 < i < 14))
+            self.assertTrue(any(i < j for i, j in sample))
+            self.assertTrue(any(i > j for i, j in sample))
+            self.assertTrue(any(i + j > maxImmediate for i, j in sample))
+
+        def test_all_classes(self):
+            ranges = [(0, 8), (4, 10), (6, 12)]
+            cases = list(itertools.product(*[range(*r) for r in ranges]))
+            classes = set(caseClass(case, ranges) for case in cases)
+
+            sample = self._sample(ranges, len(classes))
+            self.assertEqual(set(caseClass(case, ranges) for case in sample),
+                             classes)
+
+        def test_singletons(self):
+            cases = list(range(15))
+            sample = stratifiedSample(cases, [(0, 15)], 3)
+
+            self.assertEqual(len(sample), 3)
+            self.assertEqual((sample[0], sample[-1]), (0, 14))
+
+    unittest.main()
@@ -9,12 +9,17 @@
 '''
 from __future__ import print_function
 
+import sys
 import unittest
-import random
 import os
 import itertools
+import csv
+import json
 
-from test_utils import run, InfiniteLoopError
+import test_utils
+from test_utils import run, InfiniteLoopError, PhaseTimes
+from customprog import InstructionBudgetError
+from governor import CPUTimeLimitError
 
 maxValue = 15
 
@@ -29,32 +34,104 @@ def rangeGroup(args):
     return map(singletonToInt,
                itertools.product(*[range(*item) for item in args]))
 
+# seed of the FAST samples, recorded in result.csv
+seed = None
+
 if 'FAST' in os.environ:
+    from sampling import stratifiedSample
+
     limit = int(os.environ['FAST'])
+    seed = int(os.environ.get('SEED', 0))
 
     _rangeGroup = rangeGroup
 
+    def rangeGroup(args):
+        # the same cases for a given seed, on the boundaries first
+        return stratifiedSample(_rangeGroup(args), args, limit, seed)
+
+# the programs of a rangeGroup loop are run together, lane-parallel
+batching = False
+pending = []
+
+if 'BATCH' in os.environ:
+    _batchRangeGroup = rangeGroup
+
+    def flushBatch():
+        items = pending[:]
+        del pending[:]
+
+        errors = test_utils.runBatch([state for _, state, _ in items])
+        for (test, state, needed), error in zip(items, errors):
+            if error is not None:
+                raise error
+
+            for i in needed:
+                test.assertIn(i, state.registers.values())
+
     def rangeGroup(*args):
-        l = list(_rangeGroup(*args))
+        global batching
 
-        return random.sample(l, limit)
+        batching = True
+        try:
+            for case in _batchRangeGroup(*args):
+                yield case
+
+            flushBatch()
+        finally:
+            batching = False
+            del pending[:]
+
+
+# phases of the programs of each test, see test_utils.PhaseTimes
+timings = {}
 
 
 class TestCase(unittest.TestCase):
-    def _testRun(self, code, *needed):
-        state = run(code)
+    def setUp(self):
+        test_utils.phases.reset()
+        test_utils.startCapture(self._testMethodName)
+
+    def tearDown(self):
+        times = timings[self._testMethodName] = PhaseTimes()
+        times.add(test_utils.phases)
+
+    def run(self, result=None):
+        if result is None:
+            result = self.defaultTestResult()
+
+        problems = len(result.failures) + len(result.errors)
+        unittest.TestCase.run(self, result)
+
+        # last output of the visitor, with the ring capture policy
+        output = test_utils.captured()
+        if output and len(result.failures) + len(result.errors) > problems:
+            print('\n--- last output of %s ---' % self._testMethodName,
+                  file=sys.stderr)
+            print(output, file=sys.stderr)
 
-        state.run()
+        return result
+
+    def _testRun(self, code, *needed):
+        run(code, execute=True)
 
     def _testIn(self, code, *needed):
-        state = run(code)
+        if batching:
+            try:
+                state = run(code)
+            except Exception:
+                # report the failures of the previous cases first
+                flushBatch()
+                raise
+
+            pending.append((self, state, needed))
+            return
+
+        state = run(code, execute=True)
 
         # print('-' * 100)
         # for instr in state.instrs:
         #   print(instr)
 
-        state.run()
-
         for i in needed:
             self.assertIn(i, state.registers.values())
 
@@ -252,7 +329,7 @@ class TestCase(unittest.TestCase):
         }'''
 
         with self.assertRaises(InfiniteLoopError):
-            run(code).run()
+            run(code, execute=True)
 
         self._testRun('''
         while(false)
@@ -550,7 +627,7 @@ class TestCase(unittest.TestCase):
 
             if infiniteLoop:
                 with self.assertRaises(InfiniteLoopError):
-                    run(code).run()
+                    run(code, execute=True)
             else:
                 self._testIn(code, 15)
 
@@ -568,7 +645,7 @@ class TestCase(unittest.TestCase):
 
             if infiniteLoop:
                 with self.assertRaises(InfiniteLoopError):
-                    run(code).run()
+                    run(code, execute=True)
             else:
                 self._testIn(code, 15)
 
@@ -955,15 +1032,9 @@ categories = {
         'test_non_mutable_mod',
     ]
 }
-if __name__ == '__main__':
-    import csv
 
-    result = unittest.main(exit=False).result
-
-    errTests = {}
-    for item in (result.failures + result.errors):
-        errTests[item[0].id().split('.')[-1]] = 'Exception: Not Yet Implemented' in item[1]
 
+def testNames():
     tests = []
     for test in dir(TestCase):
         if test.startswith("test_"):
@@ -971,53 +1042,178 @@ if __name__ == '__main__':
 
     tests.sort()
 
-    with open('result.csv', 'w') as f:
-        writer = csv.writer(f)
-
-        def testResults():
-            labels = []
-            totalOk = 0
-            totalNotImplemented = 0
-            totalBug = 0
-            for test in tests:
-                label = ''
-                if test in errTests:
-                    if errTests[test]:
-                        totalNotImplemented += 1
-                        label = "Not Implemented"
-                    else:
-                        totalBug += 1
-                        label = "Bug"
+    return tests
+
+
+def isNotImplemented(traceback):
+    return 'Exception: Not Yet Implemented' in traceback
+
+
+# labels of the tests stopped by a budget of test_utils.limits
+budgetLabels = [
+    (CPUTimeLimitError, "CPU Time Limit"),
+    (MemoryError, "Memory Limit"),
+    (InstructionBudgetError, "Instruction Budget"),
+]
+
+
+def errorLabel(exception, traceback):
+    # exception is the class of the error of the test
+    if isNotImplemented(traceback):
+        return "Not Implemented"
+
+    for cls, label in budgetLabels:
+        if exception is not None and issubclass(exception, cls):
+            return label
+
+    return "Bug"
+
+
+class GradingResult(unittest.TextTestResult):
+    # records the class of the exception of each failing test,
+    # for errorLabel
+    def __init__(self, *args, **kwargs):
+        unittest.TextTestResult.__init__(self, *args, **kwargs)
+        self.exceptions = {}
+
+    def addError(self, test, err):
+        self.exceptions[test.id().split('.')[-1]] = err[0]
+        unittest.TextTestResult.addError(self, test, err)
+
+    def addFailure(self, test, err):
+        self.exceptions[test.id().split('.')[-1]] = err[0]
+        unittest.TextTestResult.addFailure(self, test, err)
+
+
+# prefix of the result line printed when RESULT_RECORD is set
+recordPrefix = 'RESULT_RECORD '
+
+
+def resultRows(errTests, timings=None):
+    # errTests maps each failing test to its errorLabel, timings each
+    # test to its PhaseTimes
+    tests = testNames()
+    timings = timings or {}
+
+    def testResults():
+        labels = []
+        totalOk = 0
+        totalNotImplemented = 0
+        totalBug = 0
+        for test in tests:
+            label = ''
+            if test in errTests:
+                label = errTests[test]
+                if label == "Not Implemented":
+                    totalNotImplemented += 1
                 else:
-                    totalOk += 1
-                    label = "Ok"
+                    totalBug += 1
+            else:
+                totalOk += 1
+                label = "Ok"
+
+            labels.append(label)
+
+        return labels, totalOk, totalNotImplemented, totalBug
+
+    labels, totalOk, totalNotImplemented, totalBug = testResults()
+
+    def computeCategories():
+        catLabels = []
+        catValues = []
+        for catlabel, cattests in categories.items():
+            catLabels.append(catlabel)
+
+            nbTests = 0
+            nbOk = 0
+            for t in cattests:
+                assert t in dir(TestCase), t
+                nbTests += 1
+                if t not in errTests:
+                    nbOk += 1
+            catValue = "%s / %s" % (nbOk, nbTests)
+            catValues.append(catValue)
 
-                labels.append(label)
+        return catLabels, catValues
 
-            return labels, totalOk, totalNotImplemented, totalBug
+    catLabels, catValues = computeCategories()
 
-        labels, totalOk, totalNotImplemented, totalBug = testResults()
+    # share of the executed instructions run as fused pairs
+    total = PhaseTimes()
+    for times in timings.values():
+        total.add(times)
+    fusion = "%.1f%%" % (100. * total.fused / total.instructions) if total.instructions else ""
 
-        def computeCategories():
-            catLabels = []
-            catValues = []
-            for catlabel, cattests in categories.items():
-                catLabels.append(catlabel)
+    timingHeader, timingRow = timingColumns(timings)
 
-                nbTests = 0
-                nbOk = 0
-                for t in cattests:
-                    assert t in dir(TestCase), t
-                    nbTests += 1
-                    if t not in errTests:
-                        nbOk += 1
-                catValue = "%s / %s" % (nbOk, nbTests)
-                catValues.append(catValue)
+    return (["TotalOk", "TotalNotImplemented", "TotalBug", ""] + catLabels + [""] + tests + ["", "Seed", "Fused instructions", ""] + timingHeader,
+            ["%d / %d" % (totalOk, len(tests)), totalNotImplemented, totalBug, ""] + catValues + [""] + labels + ["", "" if seed is None else seed, fusion, ""] + timingRow)
 
-            return catLabels, catValues
 
-        catLabels, catValues = computeCategories()
+# phases of PhaseTimes in the timing columns of result.csv
+phaseColumns = [('parse', "parse (s)"), ('codegen', "codegen (s)"),
+                ('analysis', "analysis (s)"), ('run', "run (s)")]
+
+
+def timingColumns(timings):
+    # for each category then each test, the phases of its programs and
+    # the instructions they executed
+    header = []
+    row = []
+    for name, group in list(categories.items()) + [(t, [t]) for t in testNames()]:
+        times = PhaseTimes()
+        for t in group:
+            if t in timings:
+                times.add(timings[t])
+
+        for phase, label in phaseColumns:
+            header.append("%s %s" % (name, label))
+            row.append("%.3f" % getattr(times, phase))
+        header.append("%s instructions" % name)
+        row.append(times.instructions)
+
+    return header, row
+
+
+def slowestTests(timings, n=10):
+    # report of the n tests which took the most time
+    lines = []
+    for test in sorted(timings, key=lambda t: timings[t].total(), reverse=True)[:n]:
+        times = timings[test]
+        lines.append("%-40s %8.3fs (parse %.3fs, codegen %.3fs, analysis %.3fs, run %.3fs, %d instructions)" %
+                     (test, times.total(), times.parse, times.codegen, times.analysis, times.run, times.instructions))
+
+    return lines
+
+
+def writeResults(errTests, timings=None, filename='result.csv'):
+    header, row = resultRows(errTests, timings)
+
+    if 'RESULT_RECORD' in os.environ:
+        # one structured line on stdout instead of a shared file,
+        # so several students can be graded at once
+        print(recordPrefix + json.dumps({'header': header, 'row': row}))
+    else:
+        with open(filename, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerow(row)
+
+def errorTests(result):
+    # failing tests of a GradingResult, as expected by resultRows
+    errTests = {}
+    for item in (result.failures + result.errors):
+        name = item[0].id().split('.')[-1]
+        errTests[name] = errorLabel(result.exceptions.get(name), item[1])
+
+    return errTests
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(resultclass=GradingResult)
+    result = unittest.main(exit=False, testRunner=runner).result
 
-        writer.writerow(["TotalOk", "TotalNotImplemented", "TotalBug", ""] + catLabels + [""] + tests)
-        writer.writerow(["%d / %d" % (totalOk, len(tests)), totalNotImplemented, totalBug, ""] + catValues + [""] + labels)
+    print("Slowest tests:", file=sys.stderr)
+    for line in slowestTests(timings, int(os.environ.get('SLOWEST', 10))):
+        print(line, file=sys.stderr)
 
+    writeResults(errorTests(result), timings)
@@ -1,26 +1,274 @@
 import sys
+import time
 import os.path
-import cStringIO
+import hashlib
+import collections
 
 from antlr4 import CommonTokenStream, InputStream
-from customprog import CustomProg, State, InfiniteLoopError
+from antlr4.atn.PredictionMode import PredictionMode
+from antlr4.error.ErrorStrategy import BailErrorStrategy, DefaultErrorStrategy
+from antlr4.error.Errors import ParseCancellationException
+import customprog
+from customprog import (CustomProg, Program, State, InfiniteLoopError,
+                        InstructionBudgetError)
+from analysis import Analysis
+from governor import Governor
+
+if 'COMPILED' in os.environ:
+    from blockcompiler import CompiledState as State
+
+# programs run without their no-ops, or also compared with the original
+# run when OPTIMIZE=validate
+if os.environ.get('OPTIMIZE') == 'validate':
+    from optimizer import ValidatingState as State
+elif 'OPTIMIZE' in os.environ:
+    from optimizer import OptimizedState as State
+
+# programs run as LC-3 machine code, with 16-bit registers
+if 'LC3' in os.environ:
+    from lc3 import LC3State as State
 
 from MuLexer import MuLexer
 from MuParser import MuParser
 from MyMuCodeGenVisitor import MyMuCodeGenVisitor
 
+import MuLexer as MuLexerModule
+import MuParser as MuParserModule
 import MyMuCodeGenVisitor as MyMuCodeGenVisitorModule
 
 # monkey patch
 MyMuCodeGenVisitorModule.LC3Prog = CustomProg
 
+# emitted instructions are cached on disk, per Mu source and
+# version of the student files
+cache = None
+
+if 'CACHE_DIR' in os.environ:
+    from compilecache import CompileCache
+
+    cache = CompileCache(os.environ['CACHE_DIR'])
+    cacheFiles = [module.__file__ for module in [MuLexerModule,
+                                                 MuParserModule,
+                                                 MyMuCodeGenVisitorModule,
+                                                 customprog]] + [__file__]
+
+
+student = None
+
+
+def studentName():
+    # hash of the student files, their directory and content, to name
+    # what several students may write to the same directory
+    global student
+
+    if student is None:
+        from compilecache import sourceFile
+
+        h = hashlib.sha1()
+        for module in [MuLexerModule, MuParserModule,
+                       MyMuCodeGenVisitorModule]:
+            filename = os.path.realpath(sourceFile(module.__file__))
+            h.update(filename.encode('utf8') + b'\0')
+            with open(filename, 'rb') as f:
+                h.update(hashlib.sha1(f.read()).digest())
+        student = h.hexdigest()[:16]
+
+    return student
+
+
+# programs generated by the visitor are saved there, to be run again by
+# programfile.py, named after the student and the sha1 of their source
+archive = os.environ.get('ARCHIVE_DIR')
+if archive is not None:
+    import programfile
+
+    if not os.path.isdir(archive):
+        os.makedirs(archive)
+
+
+def archiveProgram(source, instrs):
+    # saved once per student and source
+    if not isinstance(source, bytes):
+        source = source.encode('utf8')
+    name = '%s-%s.mup' % (studentName(), hashlib.sha1(source).hexdigest())
+    path = os.path.join(archive, name)
+
+    if not os.path.exists(path):
+        programfile.save(instrs, path)
+
+
+# budgets of each program, from its parsing to the end of its run:
+# CPU seconds, megabytes of address space, and instructions emitted.
+# None unless set, as they depend on the machine
+limits = {
+    'cpuTime': (float(os.environ['CPU_TIME'])
+                if 'CPU_TIME' in os.environ else None),
+    'memory': (int(os.environ['MEMORY_MB']) * 1024 * 1024
+               if 'MEMORY_MB' in os.environ else None),
+    'instructions': (int(os.environ['INSTRUCTION_BUDGET'])
+                     if 'INSTRUCTION_BUDGET' in os.environ else None),
+}
+
+# operands of the instructions are checked once the code is generated
+deferValidation = 'DEFER_VALIDATION' in os.environ
+
+# programs are analysed before being run, see run
+analysing = 'ANALYSE' in os.environ
+
+
+class NullSink:
+    # file which discards what is written
+    def write(self, s):
+        pass
+
+    def writelines(self, lines):
+        pass
+
+    def flush(self):
+        pass
+
+
+class RingBuffer:
+    # file which only keeps the last size characters written
+    def __init__(self, size):
+        self.size = size
+        self.chunks = collections.deque()
+        self.length = 0
+
+    def write(self, s):
+        if len(s) > self.size:
+            s = s[-self.size:]
+
+        self.chunks.append(s)
+        self.length += len(s)
+
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.chunks)[-self.size:]
+
+# what becomes of the output of the student visitors, CAPTURE is
+# - null: discarded (default)
+# - ring or ring:KB: the last KB (default 64) are kept, and shown for
+#   the failing tests
+# - file:directory: appended to directory/<student>-<pid>/<test name>.log,
+#   a directory per student and process as several may share directory
+capturePolicy = os.environ.get('CAPTURE', 'null')
+capture = None
+
+
+def startCapture(name, policy=None):
+    # output of the programs of the test name, until the next call
+    global capture
+
+    if hasattr(capture, 'close'):
+        # a log file
+        capture.close()
+
+    policy = policy or capturePolicy
+    kind, _, arg = policy.partition(':')
+    if kind == 'null':
+        capture = NullSink()
+    elif kind == 'ring':
+        capture = RingBuffer(int(arg or 64) * 1024)
+    elif kind == 'file':
+        directory = os.path.join(arg, '%s-%d' % (studentName(), os.getpid()))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        capture = open(os.path.join(directory, name + '.log'), 'a')
+    else:
+        raise ValueError('unknown capture policy %r' % policy)
+
 
-def run(inputname, debug=False):
-    input_s = InputStream(inputname)
-    lexer = MuLexer(input_s)
-    stream = CommonTokenStream(lexer)
-    parser = MuParser(stream)
-    tree = parser.prog()
+def captured():
+    # output kept for the current test, or None
+    if isinstance(capture, RingBuffer):
+        return capture.getvalue()
+
+    return None
+
+
+class PhaseTimes:
+    # wall time spent in each phase of some programs, the number of
+    # instructions they executed, and how many of them were fused
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.parse = 0.
+        self.codegen = 0.
+        self.analysis = 0.
+        self.run = 0.
+        self.instructions = 0
+        self.fused = 0
+
+    def add(self, other):
+        self.parse += other.parse
+        self.codegen += other.codegen
+        self.analysis += other.analysis
+        self.run += other.run
+        self.instructions += other.instructions
+        self.fused += other.fused
+
+    def total(self):
+        return self.parse + self.codegen + self.analysis + self.run
+
+# phases of the programs handled since the last reset
+phases = PhaseTimes()
+
+
+class ParsingContext:
+    # The lexer and parser of the student are reset for each program
+    # instead of being built again, and keep their warm DFA cache.
+    def __init__(self):
+        self.lexer = MuLexer(InputStream(''))
+        self.parser = MuParser(CommonTokenStream(self.lexer))
+
+    def parse(self, source):
+        self.lexer.inputStream = InputStream(source)
+        stream = CommonTokenStream(self.lexer)
+
+        parser = self.parser
+        parser.setTokenStream(stream)
+
+        # SLL prediction is much faster, and enough for almost all the
+        # programs; it bails out on the first error
+        parser._interp.predictionMode = PredictionMode.SLL
+        parser._errHandler = BailErrorStrategy()
+
+        try:
+            return parser.prog()
+        except ParseCancellationException:
+            # real syntax error or SLL conflict: parse again with full
+            # LL, which reports errors as usual
+            stream.seek(0)
+            parser.reset()
+            parser._interp.predictionMode = PredictionMode.LL
+            parser._errHandler = DefaultErrorStrategy()
+
+            return parser.prog()
+
+parsing = None
+
+
+def codegen(inputname, budget=None, sink=None):
+    global parsing
+
+    if parsing is None:
+        parsing = ParsingContext()
+
+    start = time.time()
+    tree = parsing.parse(inputname)
+    parser = parsing.parser
+    phases.parse += time.time() - start
 
     (hd, rest) = os.path.splitext(inputname)
     output_name = hd + ".asm"
@@ -36,33 +284,144 @@ def run(inputname, debug=False):
 
     # mock the visitor
     prog = CustomProg()
+    prog.budget = budget
+    prog.deferValidation = deferValidation
     visitor3._prog = prog
     # parser is there to provide basic PP for expressions.
 
+    if sink is None:
+        if capture is None:
+            startCapture('codegen')
+        sink = capture
+
     backstdout = sys.stdout
-    sys.stdout = cStringIO.StringIO()
+    sys.stdout = sink
 
+    start = time.time()
     try:
         visitor3.visit(tree)
+    except Exception:
+        if deferValidation:
+            # an invalid instruction emitted before would have stopped
+            # the visitor first, e.g. before a Not Yet Implemented
+            prog.validate()
+        raise
     finally:
         sys.stdout = backstdout
+        phases.codegen += time.time() - start
+
+    # checked and linked: missing or duplicate labels are reported
+    # before running anything
+    return prog._listIns, prog.finalize()
+
 
-    instrs = prog._listIns
+def run(inputname, debug=False, analyse=None, sink=None, execute=False):
+    # state of the program of the source inputname, to be run. With
+    # execute, it is run here, within the budgets, and timed. analyse
+    # is ANALYSE by default
+    if analyse is None:
+        analyse = analysing
 
-    state = State(instrs)
+    governor = Governor(**limits)
+
+    with governor:
+        instrs = None
+
+        if cache is not None:
+            key = cache.key(inputname, cacheFiles)
+            instrs = cache.get(key)
+
+        if instrs is None:
+            instrs, program = codegen(inputname, governor.instructions, sink)
+
+            if cache is not None:
+                cache.put(key, instrs)
+        elif (governor.instructions is not None and
+              len(instrs) > governor.instructions):
+            raise InstructionBudgetError(governor.instructions)
+        else:
+            # cached once linked by codegen
+            program = Program(instrs)
+
+        if archive is not None:
+            archiveProgram(inputname, instrs)
+
+        # programs which are certain to fail are classified without running
+        if analyse:
+            start = time.time()
+            try:
+                error = Analysis(instrs, program=program).error
+            finally:
+                phases.analysis += time.time() - start
+
+            if error is not None:
+                raise error
+
+    # deterministic programs which come back to the same state
+    # are stopped as soon as possible, as InfiniteLoopError
+    state = State(instrs, program=program, detectLoops=True)
+
+    # what remains of the budgets for its run, see runBatch
+    state.governor = governor
+
+    if execute:
+        # with what remains of the budgets of the program
+        start = time.time()
+        try:
+            with governor:
+                state.run()
+        finally:
+            phases.run += time.time() - start
+            phases.instructions += state.executed
+            phases.fused += 2 * state.fusedHits
 
     return state
 
 
+def runBatch(states):
+    # Runs states returned by run, lane-parallel with batchstate, and
+    # returns the error of each of them or None. The batch has the CPU
+    # time which remains to all of them, and the memory of one.
+    from batchstate import runStates
+
+    cpuTimes = [state.governor.cpuTime for state in states]
+    governor = Governor(None if None in cpuTimes else sum(cpuTimes),
+                        limits['memory'])
+
+    start = time.time()
+    try:
+        with governor:
+            errors = runStates(states)
+    finally:
+        phases.run += time.time() - start
+        phases.instructions += sum(state.executed for state in states)
+        phases.fused += sum(2 * state.fusedHits for state in states)
+
+    return errors
+
+
 def runfile(filename):
-    state = run(open(filename).read(), True)
+    state = run(open(filename).read(), True, analyse=False)
+
+    if 'PROFILE' in os.environ:
+        from profiler import ProfiledState
+
+        state = ProfiledState(state.instrs, program=state.program,
+                              detectLoops=True)
 
     for instr in state.instrs:
         print(instr)
 
+    for line in Analysis(state.instrs, program=state.program).describe():
+        print(line)
+
     state.run()
 
     print(state.registers)
 
+    if 'PROFILE' in os.environ:
+        for line in state.report():
+            print(line)
+
 if __name__ == '__main__':
     runfile(sys.argv[1])